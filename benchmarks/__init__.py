@@ -0,0 +1,12 @@
+'''
+Benchmarks.
+
+Run as modules, in a configured project, e.g. ::
+
+    python -m updownrecord.benchmarks.freecfg_tokenizer
+
+throughput, the per-format serialize/deserialize suite, sets up its
+own in-memory database, so runs standalone ::
+
+    python -m updownrecord.benchmarks.throughput --rows 10 1000 100000 --output results.json
+'''
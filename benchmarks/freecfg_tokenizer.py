@@ -0,0 +1,186 @@
+import sys
+import time
+import random
+import argparse
+
+from django.conf import settings
+
+if (not settings.configured):
+    settings.configure()
+
+from ..freecfg import freecfg
+from ..freecfg import Reader, DictReader, Parser
+
+
+'''
+Benchmark the one-match FreeCFG line tokenizer against the previous 
+three-regex line handling (kept below as LegacyReader/LegacyParser).
+
+A large FreeCFG text is generated, with one-line and paragraph values,
+comments and blank lines. Each reader parses it, results are checked 
+equal, and the best of several runs is reported.
+
+    python -m updownrecord.benchmarks.freecfg_tokenizer --sections 20000
+'''
+class LegacyReader(Reader):
+    '''
+    Reader, with the line handling before the single-pass tokenizer.
+    '''
+    def streamToIter(self, stream):
+        for line in stream:
+            yield line
+
+    def get_line(self):
+        while (True):
+            self.linecount += 1
+            self.line = next(self.it)
+            mo = freecfg.ignoreRE.match(self.line)
+            if (not mo):
+                break
+
+    def section(self):
+        self.mo = freecfg.sectionRE.match(self.line)
+        return bool(self.mo)
+
+    def keyline(self):
+        self.mo = freecfg.keyRE.match(self.line)
+        return bool(self.mo)        
+        
+    def get_value(self, builder):
+        while(True):
+            try:
+                self.get_line()
+            except StopIteration:
+                self.exhausted = True
+                break
+            if (self.section() or self.keyline()):
+                break
+            builder.append(self.line)
+        return ''.join(builder)
+
+    def __next__(self):
+        if (self.exhausted):
+            raise StopIteration
+        elif (self.section()):
+            title = self.mo.group(1)
+            self.get_line()
+            return freecfg.Section(title)
+        elif (self.keyline()):
+            key = self.mo.group(1)
+            value = self.get_value([self.mo.group(2)])
+            return freecfg.Entry(key, value)
+
+
+
+class LegacyDictReader(DictReader):
+    def __init__(self, stream_or_string):
+        self.reader = LegacyReader(stream_or_string)
+        self.event = None
+        self.exhausted = False
+        try:
+            self.get_event()
+        except StopIteration:
+            self.exhausted = True
+
+
+
+class LegacyParser(Parser):
+    '''
+    Parser, with the line handling before the single-pass tokenizer.
+    '''
+    def _parse(self): 
+        while(True):
+            line = self.get_line()
+            if (not freecfg.ignoreRE.match(line)):
+                break
+        mo = freecfg.sectionRE.match(line)
+        if (mo):
+            self.section_open(mo.group(1))
+        else:
+            mo = freecfg.keyRE.match(line)
+            if (not mo):
+                raise freecfg.ParsingError('First significant line is not a section or key mark.')
+            if (self.seq_is_dict):         
+                raise freecfg.ParsingError('First significant line is key/value mark, but seq_is_dict=True.')
+            self.kv_open(mo.group(1), mo.group(2))         
+        for line in self.it:      
+            mo = freecfg.keyRE.match(line)
+            if (mo):
+                self.kv_close()
+                self.kv_open(mo.group(1), mo.group(2))
+                continue
+            mo = freecfg.sectionRE.match(line)
+            if (mo):
+                self.section_close()
+                self.section_open(mo.group(1))
+                continue  
+            if (freecfg.ignoreRE.match(line)):
+                continue 
+            self.current_value.append(line)
+        self.section_close()
+        return self.seq_b
+
+
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit')
+
+def make_text(sections, keys=8, paragraph_lines=6, seed=0):
+    '''
+    @return FreeCFG text of 'sections' sections, each of 'keys' 
+    entries. One entry in each section is a paragraph.
+    '''
+    rnd = random.Random(seed)
+    b = []
+    for i in range(sections):
+        b.append('[section {}]\n'.format(i))
+        if (i % 10 == 0):
+            b.append('# comment\n\n')
+        for k in range(keys):
+            if (k == keys - 1):
+                b.append('text = {}\n'.format(' '.join(rnd.choice(WORDS) for _ in range(8))))
+                for _ in range(paragraph_lines):
+                    b.append(' '.join(rnd.choice(WORDS) for _ in range(12)) + '\n')
+                b.append('\n')
+            else:
+                b.append('key{} = {}\n'.format(k, rnd.randint(0, 10**6)))
+    return ''.join(b)
+
+
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+    return min(times), result
+
+
+def run(sections=20000, repeat=3, out=sys.stdout):
+    text = make_text(sections)
+    size = len(text.encode('utf-8')) / 1e6
+    out.write('FreeCFG tokenizer: {} sections, {:.1f}MB\n'.format(sections, size))
+    cases = (
+        ('Reader', lambda: list(LegacyReader(text)), lambda: list(Reader(text))),
+        ('DictReader', lambda: list(LegacyDictReader(text)), lambda: list(DictReader(text))),
+        ('Parser', lambda: LegacyParser().parse_text(text), lambda: Parser().parse_text(text)),
+    )
+    for name, legacy, current in cases:
+        t_legacy, r_legacy = best(legacy, repeat)
+        t_current, r_current = best(current, repeat)
+        if (r_legacy != r_current):
+            raise AssertionError('{}: results differ from the legacy reader'.format(name))
+        out.write('{:<12} legacy {:.3f}s  current {:.3f}s  ({:.2f}x, {:.1f}MB/s)\n'.format(
+            name, t_legacy, t_current, t_legacy / t_current, size / t_current
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the FreeCFG tokenizer')
+    parser.add_argument('--sections', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    run(args.sections, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import decimal
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+
+import django
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# the app package, which holds the synthetic models
+APP_LABEL = __package__.rsplit('.', 1)[0]
+
+if (settings.configured):
+    raise ImproperlyConfigured('The throughput benchmark sets up its own in-memory database, so must run standalone (python -m {}.benchmarks.throughput)'.format(APP_LABEL))
+
+settings.configure(
+    INSTALLED_APPS=[APP_LABEL],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    SERIALIZATION_MODULES={
+        'nonrel_csv': APP_LABEL + '.serializers.csv',
+        'nonrel_freecfg': APP_LABEL + '.serializers.freecfg',
+        'nonrel_json': APP_LABEL + '.serializers.json',
+        'nonrel_jsonl': APP_LABEL + '.serializers.jsonl',
+        'nonrel_xml': APP_LABEL + '.serializers.xml',
+        'nonrel_columnar': APP_LABEL + '.serializers.columnar',
+    },
+    USE_TZ=False,
+)
+django.setup()
+
+from django.db import connection, models
+from django.core import serializers
+
+from ..views import SERIALIZATION_DATA
+from ..serializers.nonrelational_base import NonrelationalSerializer
+
+
+'''
+Serialize and deserialize throughput of every format in
+SERIALIZATION_DATA.
+
+Synthetic models (narrow, wide, text-heavy, numeric, and dates/
+decimals) are filled with generated rows in an in-memory SQLite
+database. For each model, format and row count the suite times,
+
+    serialize           serialize() of a queryset, to a file
+    serialize_values    the same, with use_values=True (non-relational
+                        serializers only)
+    deserialize         iterating deserialize() over the file
+
+and reports rows/s, MB/s (of serialized data), and peak Python memory
+(tracemalloc, in a separate untimed run; memory held by SQLite is not
+seen). Times are the best of several runs.
+
+Results can be written as JSON, and checked against a baseline (an
+earlier results file). Throughput lower, or peak memory higher, than
+the baseline by more than the tolerance is a regression, and the exit
+status is 1. Runs too short to time reliably are not compared.
+
+    python -m updownrecord.benchmarks.throughput --rows 10 1000 100000 --output base.json
+    python -m updownrecord.benchmarks.throughput --rows 10 1000 100000 --baseline base.json
+
+Baselines are only comparable on the same machine.
+'''
+ROW_COUNTS = (10, 100, 1000, 10000, 100000, 1000000)
+
+# rows per bulk_create() when filling tables
+FILL_BATCH_SIZE = 10000
+
+# baseline entries shorter, or smaller, than this are not compared
+MIN_COMPARE_TIME = 0.05
+MIN_COMPARE_PEAK = 64 * 1024
+
+WORDS = (
+    'firework', 'rocket', 'fountain', 'sparkler', 'mine', 'cake', 'star',
+    'whistle', 'crackle', 'comet', 'willow', 'peony', 'gold', 'silver',
+    'red', 'green', '"quoted"', 'a, b', '<tag>', '&amp', 'naïve', 'ünïcode',
+)
+
+
+
+def bench_model(name, fields):
+    attrs = dict(fields)
+    attrs['__module__'] = __name__
+    attrs['Meta'] = type('Meta', (), {'app_label': APP_LABEL, 'db_table': 'bench_' + name.lower()})
+    return type(name, (models.Model,), attrs)
+
+
+def wide_fields():
+    fields = {}
+    for i in range(10):
+        fields['text{}'.format(i)] = models.CharField(max_length=64)
+        fields['int{}'.format(i)] = models.IntegerField()
+        fields['float{}'.format(i)] = models.FloatField()
+    fields['flag0'] = models.BooleanField()
+    fields['flag1'] = models.BooleanField()
+    return fields
+
+
+BenchNarrow = bench_model('BenchNarrow', {
+    'title': models.CharField(max_length=100),
+    'count': models.IntegerField(),
+})
+
+BenchWide = bench_model('BenchWide', wide_fields())
+
+BenchText = bench_model('BenchText', {
+    'title': models.CharField(max_length=200),
+    'body': models.TextField(),
+})
+
+BenchNumeric = bench_model('BenchNumeric', {
+    'small': models.SmallIntegerField(),
+    'count': models.IntegerField(),
+    'big': models.BigIntegerField(),
+    'ratio': models.FloatField(),
+    'weight': models.FloatField(),
+    'score': models.FloatField(),
+    'live': models.BooleanField(),
+})
+
+BenchTemporal = bench_model('BenchTemporal', {
+    'day': models.DateField(),
+    'created': models.DateTimeField(),
+    'at': models.TimeField(),
+    'price': models.DecimalField(max_digits=12, decimal_places=2),
+    'rate': models.DecimalField(max_digits=18, decimal_places=6),
+})
+
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def make_narrow(rng, i):
+    return BenchNarrow(title=words(rng, 4), count=i)
+
+
+def make_wide(rng, i):
+    kwargs = {}
+    for j in range(10):
+        kwargs['text{}'.format(j)] = words(rng, 3)
+        kwargs['int{}'.format(j)] = rng.randint(-2**31, 2**31 - 1)
+        kwargs['float{}'.format(j)] = rng.random() * 1e6
+    kwargs['flag0'] = bool(i & 1)
+    kwargs['flag1'] = rng.random() < 0.5
+    return BenchWide(**kwargs)
+
+
+def make_text(rng, i):
+    paragraphs = [words(rng, rng.randint(40, 120)) for _ in range(rng.randint(1, 4))]
+    return BenchText(title=words(rng, 8), body='\n\n'.join(paragraphs))
+
+
+def make_numeric(rng, i):
+    return BenchNumeric(
+        small=rng.randint(-32768, 32767),
+        count=i,
+        big=rng.randint(-2**63, 2**63 - 1),
+        ratio=rng.random(),
+        weight=rng.random() * 1e3,
+        score=rng.gauss(0, 1e9),
+        live=rng.random() < 0.5,
+    )
+
+
+EPOCH = datetime.datetime(2000, 1, 1)
+
+
+def make_temporal(rng, i):
+    created = EPOCH + datetime.timedelta(seconds=rng.randint(0, 10**9), microseconds=rng.randint(0, 999999))
+    return BenchTemporal(
+        day=created.date(),
+        created=created,
+        at=created.time(),
+        price=decimal.Decimal(rng.randint(0, 10**10)).scaleb(-2),
+        rate=decimal.Decimal(rng.randint(-10**17, 10**17)).scaleb(-6),
+    )
+
+
+# name -> (model, row factory)
+MODELS = {
+    'narrow': (BenchNarrow, make_narrow),
+    'wide': (BenchWide, make_wide),
+    'text': (BenchText, make_text),
+    'numeric': (BenchNumeric, make_numeric),
+    'temporal': (BenchTemporal, make_temporal),
+}
+
+FORMATS = [data.format for data in SERIALIZATION_DATA]
+REQUIRES_MODEL = {data.format for data in SERIALIZATION_DATA if data.requires_model}
+
+
+
+def create_tables():
+    with connection.schema_editor() as editor:
+        for model, factory in MODELS.values():
+            editor.create_model(model)
+
+
+def fill(model, factory, rows, seed=0):
+    '''
+    Add generated rows to a table, up to 'rows'. Rows are generated
+    from their index, so a table grows to the same data at any count.
+    '''
+    count = model.objects.count()
+    while (count < rows):
+        end = min(rows, count + FILL_BATCH_SIZE)
+        objs = [factory(random.Random(seed * 1000003 + i), i) for i in range(count, end)]
+        model.objects.bulk_create(objs)
+        count = end
+
+
+def is_binary(format):
+    return issubclass(serializers.get_serializer(format).stream_class, io.BytesIO)
+
+
+def format_options(format, model):
+    return {'model_class': model} if (format in REQUIRES_MODEL) else {}
+
+
+def serialize_to(path, format, model, **options):
+    '''
+    Serialize the table of a model to a file.
+    @return rows written
+    '''
+    serializer = serializers.get_serializer(format)()
+    if (is_binary(format)):
+        f = open(path, 'wb')
+    else:
+        f = open(path, 'w', encoding='utf-8', newline='')
+    with f:
+        serializer.serialize(model.objects.all(), stream=f, **format_options(format, model), **options)
+    return model.objects.count()
+
+
+def deserialize_from(path, format, model):
+    '''
+    Iterate the objects deserialized from a file.
+    @return count of objects
+    '''
+    count = 0
+    with open(path, 'rb') as f:
+        for obj in serializers.deserialize(format, f, **format_options(format, model)):
+            count += 1
+    return count
+
+
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+    return min(times), result
+
+
+def peak_memory(fn):
+    '''
+    @return peak memory allocated by Python while fn() ran
+    '''
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(op, fn, rows, path, repeat, memory):
+    seconds, count = best(fn, repeat)
+    if (count != rows):
+        raise AssertionError('{}: {} rows, expected {}'.format(op, count, rows))
+    size = os.path.getsize(path)
+    return {
+        'op': op,
+        'rows': rows,
+        'seconds': seconds,
+        'bytes': size,
+        'rows_per_s': rows / seconds,
+        'mb_per_s': size / 1e6 / seconds,
+        'peak_bytes': peak_memory(fn) if (memory) else None,
+    }
+
+
+def run(row_counts=ROW_COUNTS, model_names=None, formats=None, repeat=3, memory=True, out=sys.stdout):
+    '''
+    Run the suite.
+    @return list of result dicts
+    '''
+    model_names = model_names or list(MODELS)
+    formats = formats or FORMATS
+    results = []
+    create_tables()
+    workdir = tempfile.mkdtemp(prefix='updownrecord-bench-')
+    try:
+        for rows in sorted(row_counts):
+            for model_name in model_names:
+                model, factory = MODELS[model_name]
+                fill(model, factory, rows)
+                for format in formats:
+                    path = os.path.join(workdir, '{}.{}'.format(model_name, format))
+                    ops = [('serialize', lambda: serialize_to(path, format, model))]
+                    if (issubclass(serializers.get_serializer(format), NonrelationalSerializer)):
+                        ops.append(('serialize_values', lambda: serialize_to(path, format, model, use_values=True)))
+                    ops.append(('deserialize', lambda: deserialize_from(path, format, model)))
+                    for op, fn in ops:
+                        result = measure(op, fn, rows, path, repeat, memory)
+                        result['model'] = model_name
+                        result['format'] = format
+                        results.append(result)
+                        write_result(result, out)
+                    os.remove(path)
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return results
+
+
+def write_result(r, out):
+    out.write('{:<9} {:<16} {:<17} {:>8} rows {:>12.0f} rows/s {:>8.2f} MB/s {}\n'.format(
+        r['model'],
+        r['format'],
+        r['op'],
+        r['rows'],
+        r['rows_per_s'],
+        r['mb_per_s'],
+        '' if (r['peak_bytes'] is None) else '{:>8.2f} MB peak'.format(r['peak_bytes'] / 1e6),
+    ))
+
+
+def result_key(r):
+    return (r['model'], r['format'], r['op'], r['rows'])
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Check results against baseline results.
+    @return list of regression descriptions
+    '''
+    base = {result_key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(result_key(r))
+        if (b is None):
+            continue
+        name = '{} {} {} {} rows'.format(*result_key(r))
+        if (b['seconds'] >= MIN_COMPARE_TIME
+            and r['rows_per_s'] < b['rows_per_s'] * (1 - tolerance)):
+            regressions.append('{}: {:.0f} rows/s, baseline {:.0f} rows/s'.format(
+                name, r['rows_per_s'], b['rows_per_s']
+            ))
+        if (r['peak_bytes'] is not None and b['peak_bytes'] is not None
+            and b['peak_bytes'] >= MIN_COMPARE_PEAK
+            and r['peak_bytes'] > b['peak_bytes'] * (1 + tolerance)):
+            regressions.append('{}: {:.2f}MB peak, baseline {:.2f}MB peak'.format(
+                name, r['peak_bytes'] / 1e6, b['peak_bytes'] / 1e6
+            ))
+    return regressions
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark serialize/deserialize throughput of each format')
+    parser.add_argument('--rows', type=int, nargs='+', default=list(ROW_COUNTS))
+    parser.add_argument('--models', nargs='+', choices=list(MODELS), default=None)
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip peak memory runs')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='fail on regression against this JSON results file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fraction of slowdown, or memory growth')
+    args = parser.parse_args(argv)
+    results = run(args.rows, args.models, args.formats, args.repeat, args.memory)
+    if (args.output):
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+    if (args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for line in regressions:
+            sys.stdout.write('REGRESSION ' + line + '\n')
+        if (regressions):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
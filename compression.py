@@ -0,0 +1,87 @@
+import zlib
+
+
+'''
+Compression for downloads.
+
+'gzip' and 'deflate' are supported, both from zlib. Compression
+runs incrementally, so it can sit on a stream of serializer chunks
+without the body ever being gathered.
+
+Note that HTTP 'deflate' means zlib-wrapped deflate data, not raw
+deflate.
+'''
+ENCODINGS = ('gzip', 'deflate')
+
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# MIME and extension used when a compressed file is the download itself
+ATTACHMENT_MIME = 'application/gzip'
+ATTACHMENT_EXTENSION = 'gz'
+
+
+
+def negotiate_encoding(accept_encoding, encodings=ENCODINGS):
+    '''
+    Choose a content encoding from an Accept-Encoding header.
+
+    q-values are honoured. 'q=0' refuses an encoding. Where q-values
+    are equal, the order of 'encodings' is the preference.
+
+    @param accept_encoding the header value (may be empty)
+    @return an encoding from 'encodings', or None
+    '''
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            k, _, v = param.partition('=')
+            if (k.strip().lower() == 'q'):
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    best = None
+    best_q = 0.0
+    for encoding in encodings:
+        q = qvalues.get(encoding, qvalues.get('*', 0.0))
+        if (q > best_q):
+            best = encoding
+            best_q = q
+    return best
+
+
+
+def compressor(encoding, level=6):
+    '''
+    @return a zlib compression object for the encoding
+    '''
+    return zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+
+
+def compress(data, encoding, level=6):
+    '''
+    Compress a complete body.
+    '''
+    c = compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def compress_iter(chunks, encoding, level=6):
+    '''
+    Compress an iterable of bytes chunks, as it is read.
+
+    zlib holds back small outputs, so empty chunks are not yielded.
+    '''
+    c = compressor(encoding, level)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if (data):
+            yield data
+    yield c.flush()
@@ -1 +1,2 @@
-from .freecfg import Builder, Writer, Parser, Reader, ParsingError, Entry, Section, DictReader
+from .freecfg import Builder, Writer, Parser, Reader, FeedParser, ParsingError, Entry, Section, DictReader
+from .index import SectionIndex, IndexedReader
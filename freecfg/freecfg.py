@@ -1,5 +1,6 @@
 import re
 import io
+import codecs
 import collections
 
 from django.conf import settings
@@ -63,14 +64,25 @@ class Writer():
 class ParsingError(Exception):
     pass
 
-ignoreRE = re.compile('^\s*(?:#.*)?$') 
-sectionRE = re.compile('^\s*\[([^\]]+)\].*$')
-keyRE = re.compile('^\s*(\w+)\s?=\s*(.*)$')
+ignoreRE = re.compile(r'^\s*(?:#.*)?$') 
+sectionRE = re.compile(r'^\s*\[([^\]]+)\].*$')
+keyRE = re.compile(r'^\s*(\w+)\s?=\s*(.*)$')
+
+# The three line patterns above, as alternatives of one regex, so a
+# line is classified by one match. They can not overlap (the first
+# non-space character is '#' or none, '[', or a word character). The 
+# matched alternative is given by match.lastindex, 
+# IGNORE_LINE/SECTION_LINE/KEY_LINE. No match is value text. Groups 
+# are 2: section title, 3: key, 4: value.
+lineRE = re.compile(r'^\s*(?:((?:#.*)?)$|\[([^\]]+)\].*$|(\w+)\s?=\s*(.*)$)')
+IGNORE_LINE = 1
+SECTION_LINE = 2
+KEY_LINE = 4
 
 
 
 class Parser():
-    '''
+    r'''
     Parse input as 'freecfg'
     Freecfg is like the cfg/ini format. But the parser is unusual. It 
     can not handle escapes, and whitespace-strips all key/value
@@ -148,45 +160,40 @@ class Parser():
         # skip whitespace and comments
         while(True):
             line = self.get_line()
-            mo = ignoreRE.match(line)
-            if (not mo):
+            mo = lineRE.match(line)
+            if (not mo or mo.lastindex != IGNORE_LINE):
                 break
         
         # now on significant line
         # initialize
-        mo = sectionRE.match(line)
-        if (mo):
-            self.section_open(mo.group(1))
-        else:
-            mo = keyRE.match(line)
-            if (mo):   
-                if (self.seq_is_dict):         
-                    raise ParsingError('line:{} first significant line is key/value mark, but seq_is_dict=True.'.format(
-                        self.linecount
-                    ))
-                self.kv_open(mo.group(1), mo.group(2))         
-            else:
-                raise ParsingError('line:{} First significant line is not a section or key mark.'.format(
+        kind = mo.lastindex if (mo) else None
+        if (kind == SECTION_LINE):
+            self.section_open(mo.group(2))
+        elif (kind == KEY_LINE):
+            if (self.seq_is_dict):         
+                raise ParsingError('line:{} first significant line is key/value mark, but seq_is_dict=True.'.format(
                     self.linecount
                 ))
+            self.kv_open(mo.group(3), mo.group(4))         
+        else:
+            raise ParsingError('line:{} First significant line is not a section or key mark.'.format(
+                self.linecount
+            ))
                 
         # process body repetitively                       
+        match = lineRE.match
         for line in self.it:      
-            mo = keyRE.match(line)
-            if (mo):
-                self.kv_close()
-                self.kv_open(mo.group(1), mo.group(2))
+            mo = match(line)
+            if (not mo):
+                self.current_value.append(line)
                 continue
-            mo = sectionRE.match(line)
-            if (mo):
+            kind = mo.lastindex
+            if (kind == KEY_LINE):
+                self.kv_close()
+                self.kv_open(mo.group(3), mo.group(4))
+            elif (kind == SECTION_LINE):
                 self.section_close()
-                self.section_open(mo.group(1))
-                continue  
-            mo = ignoreRE.match(line)
-            if (mo):
-                continue 
-            else:
-                self.current_value.append(line)
+                self.section_open(mo.group(2))
                 
         # finish open data
         self.section_close()
@@ -210,7 +217,7 @@ ENTRY = 0
 Entry = collections.namedtuple('Entry', 'key value')
 Section = collections.namedtuple('Section', 'data')
 class Reader():
-    '''
+    r'''
     Parse input as 'freecfg'
     Freecfg is like the cfg/ini format. But the parser is unusual. It 
     can not handle escapes, and whitespace-strips all key/value
@@ -245,29 +252,31 @@ class Reader():
             self.exhausted = True             
 
     def streamToIter(self, stream):
-        for line in stream:
-            yield line
+        return iter(stream)
             
     def __iter__(self):
         return self
         
     def get_line(self):
+        # classify as the line is read, skipping ignorable lines
+        match = lineRE.match
         while (True):
             self.linecount += 1
             self.line = next(self.it)
-            mo = ignoreRE.match(self.line)
-            if (not mo):
+            self.mo = match(self.line)
+            if (not self.mo or self.mo.lastindex != IGNORE_LINE):
                 break
 
     def section(self):
-        self.mo = sectionRE.match(self.line)
-        return bool(self.mo)
+        return bool(self.mo) and self.mo.lastindex == SECTION_LINE
 
     def keyline(self):
-        self.mo = keyRE.match(self.line)
-        return bool(self.mo)        
+        return bool(self.mo) and self.mo.lastindex == KEY_LINE
         
-    def get_value(self, builder):
+    def get_value(self, value):
+        # Most values are one line, so a list for continuation lines
+        # is only made when one is found.
+        builder = None
         while(True):
             try:
                 self.get_line()
@@ -275,25 +284,132 @@ class Reader():
                 # stop reading, EOF
                 self.exhausted = True
                 break
-            if (self.section() or self.keyline()):
+            if (self.mo):
+                # section or key
                 break
+            if (builder is None):
+                builder = [value]
             builder.append(self.line)
-        return ''.join(builder)
+        return value if (builder is None) else ''.join(builder)
 
     def __next__(self):
         if (self.exhausted):
             raise StopIteration
         elif (self.section()):
-            title = self.mo.group(1)
+            title = self.mo.group(2)
             self.get_line()
             return Section(title)
         elif (self.keyline()):
-            key = self.mo.group(1)
-            value = self.get_value([self.mo.group(2)])
+            key = self.mo.group(3)
+            value = self.get_value(self.mo.group(4))
             return Entry(key, value)
 
 
 
+class FeedParser():
+    '''
+    Push-mode freecfg parser.
+
+    Input is given to feed() as it arrives, in chunks of any size, and
+    parsed as far as complete lines allow. Partial lines, and 
+    multibyte characters split across chunks, are held for the next 
+    chunk. close() ends the input. Parsing yields the events of Reader,
+    Section(title) and Entry(key, value), collected by read_events(). An
+    entry is complete only when the next section or key line (or the 
+    end of input) is seen.
+
+        p = FeedParser()
+        for chunk in chunks:
+            p.feed(chunk)
+            for event in p.read_events():
+                ...
+        p.close()
+        for event in p.read_events():
+            ...
+
+    Values are as Reader gives them, but a significant line which is 
+    not a section or key, and not in a value, raises ParsingError. A 
+    section header at the end of input is an event.
+
+    @param encoding of byte input. Text input is used as given.
+    '''
+    def __init__(self, encoding=settings.DEFAULT_CHARSET):
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.partial = ''
+        self.events = collections.deque()
+        self.linecount = 0
+        self.key = None
+        self.value = None
+        self.builder = None
+        self.closed = False
+
+    def feed(self, data):
+        if (self.closed):
+            raise ParsingError('FeedParser fed after close()')
+        if (not isinstance(data, str)):
+            data = self.decoder.decode(data)
+        if ('\n' not in data):
+            self.partial += data
+            return
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.handle_line(line + '\n')
+
+    def close(self):
+        '''
+        End the input. Any unfinished line and entry are parsed.
+        '''
+        if (self.closed):
+            return
+        self.partial += self.decoder.decode(b'', final=True)
+        if (self.partial):
+            self.handle_line(self.partial)
+            self.partial = ''
+        self.entry_close()
+        self.closed = True
+
+    def read_events(self):
+        '''
+        Iterate, and remove, the events parsed so far.
+        '''
+        events = self.events
+        while (events):
+            yield events.popleft()
+
+    def entry_close(self):
+        if (self.key is not None):
+            value = self.value if (self.builder is None) else ''.join(self.builder)
+            self.events.append(Entry(self.key, value))
+            self.key = None
+            self.builder = None
+
+    def handle_line(self, line):
+        self.linecount += 1
+        mo = lineRE.match(line)
+        if (not mo):
+            if (self.key is None):
+                raise ParsingError('line:{} Expected a section or key mark\n"{}"'.format(
+                    self.linecount,
+                    line
+                ))
+            # a value continues
+            if (self.builder is None):
+                self.builder = [self.value]
+            self.builder.append(line)
+            return
+        kind = mo.lastindex
+        if (kind == IGNORE_LINE):
+            return
+        self.entry_close()
+        if (kind == SECTION_LINE):
+            self.events.append(Section(mo.group(2)))
+        else:
+            self.key = mo.group(3)
+            self.value = mo.group(4)
+
+
+
 SectionData = collections.namedtuple('SectionData', 'title entries')
 class DictReader():  
     def __init__(self, stream_or_string, encoding=settings.DEFAULT_CHARSET):
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import mmap
+
+from django.conf import settings
+
+from .freecfg import FeedParser, Section, SectionData
+
+
+'''
+Section offset index for freecfg files.
+
+An index records the byte offset of every section header in a file,
+found in one pass over a memory map of the file. It can be saved as a
+sidecar file (the file path plus '.idx', JSON), which is used while
+the file size and modification time match.
+
+IndexedReader uses an index to read single sections, by title or
+ordinal, seeking to the header and parsing only that section.
+
+Headers are found as the parsers find them, a line starting '['
+(after any ASCII whitespace) with a title closed by ']'.
+'''
+headerRE = re.compile(rb'^[ \t\r\f\v]*\[([^\]\n]+)\]', re.MULTILINE)
+
+SIDECAR_EXTENSION = '.idx'
+INDEX_VERSION = 1
+
+
+
+class SectionIndex():
+    '''
+    Titles and byte offsets of the sections of a freecfg file.
+
+    @param sections list of (title, offset), in file order
+    @param size size of the indexed file
+    @param mtime modification time (ns) of the indexed file
+    '''
+    def __init__(self, sections, size=None, mtime=None):
+        self.sections = sections
+        self.size = size
+        self.mtime = mtime
+        # first section of each title
+        self.ordinals = {}
+        for ordinal, (title, offset) in enumerate(sections):
+            self.ordinals.setdefault(title, ordinal)
+
+    @classmethod
+    def build(cls, path, encoding=settings.DEFAULT_CHARSET):
+        '''
+        Index a file, in one pass over a memory map.
+        '''
+        sections = []
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if (st.st_size):
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    for mo in headerRE.finditer(m):
+                        sections.append((mo.group(1).decode(encoding), mo.start()))
+        return cls(sections, st.st_size, st.st_mtime_ns)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load an index from a sidecar file.
+        '''
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if (data.get('version') != INDEX_VERSION):
+            raise ValueError('Unknown freecfg index version: {}'.format(data.get('version')))
+        return cls([tuple(s) for s in data['sections']], data['size'], data['mtime'])
+
+    def save(self, path):
+        '''
+        Write the index to a sidecar file.
+        '''
+        data = {
+            'version': INDEX_VERSION,
+            'size': self.size,
+            'mtime': self.mtime,
+            'sections': self.sections,
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+    @classmethod
+    def for_file(cls, path, encoding=settings.DEFAULT_CHARSET, sidecar=True):
+        '''
+        Return an index for a file. If 'sidecar', a current sidecar
+        index is used, or the index is built and saved as one.
+        '''
+        if (not sidecar):
+            return cls.build(path, encoding)
+        sidecar_path = path + SIDECAR_EXTENSION
+        try:
+            index = cls.load(sidecar_path)
+        except (OSError, ValueError, KeyError):
+            index = None
+        if (index is not None and index.is_current(path)):
+            return index
+        index = cls.build(path, encoding)
+        index.save(sidecar_path)
+        return index
+
+    def is_current(self, path):
+        '''
+        @return True if the file looks unchanged since indexing
+        '''
+        st = os.stat(path)
+        return (st.st_size == self.size and st.st_mtime_ns == self.mtime)
+
+    def titles(self):
+        return [title for title, offset in self.sections]
+
+    def ordinal(self, title):
+        '''
+        @return the ordinal of the first section with the title
+        '''
+        try:
+            return self.ordinals[title]
+        except KeyError:
+            raise KeyError('No section titled "{}" in the index'.format(title))
+
+    def span(self, key):
+        '''
+        Byte range of a section.
+
+        @param key a title, or an ordinal (negative counts from the end)
+        @return (start, end), end None for the last section
+        '''
+        ordinal = self.ordinal(key) if isinstance(key, str) else key
+        start = self.sections[ordinal][1]
+        if (ordinal < 0):
+            ordinal += len(self.sections)
+        end = self.sections[ordinal + 1][1] if (ordinal + 1 < len(self.sections)) else None
+        return (start, end)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __iter__(self):
+        return iter(self.sections)
+
+
+
+class IndexedReader():
+    '''
+    Read single sections of a freecfg file, through a section index.
+
+        r = IndexedReader('/exports/fireworks.cfg')
+        d = r['firework.42']
+        d = r[0]
+
+    @param path of the freecfg file
+    @param index a SectionIndex. If None, one is got by
+    SectionIndex.for_file()
+    @param sidecar use/save a sidecar index, if no index is given
+    '''
+    def __init__(self, path, index=None, encoding=settings.DEFAULT_CHARSET, sidecar=True):
+        self.path = path
+        self.encoding = encoding
+        self.index = index if (index is not None) else SectionIndex.for_file(path, encoding, sidecar)
+
+    def section(self, key):
+        '''
+        Read a section.
+
+        @param key a title, or an ordinal
+        @return SectionData(title, entries)
+        '''
+        start, end = self.index.span(key)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read() if (end is None) else f.read(end - start)
+        parser = FeedParser(self.encoding)
+        parser.feed(data)
+        parser.close()
+        title = None
+        entries = {}
+        for event in parser.read_events():
+            if isinstance(event, Section):
+                title = event.data
+            else:
+                entries[event.key] = event.value
+        return SectionData(title=title, entries=entries)
+
+    def __getitem__(self, key):
+        return self.section(key)
+
+    def __len__(self):
+        return len(self.index)
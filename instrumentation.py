@@ -0,0 +1,193 @@
+import logging
+import contextlib
+from time import perf_counter
+
+from django.db import connections
+from django.dispatch import Signal
+
+
+'''
+Per-phase timing of downloads and uploads.
+
+A Timings object gathers the durations of named phases, and counts of
+rows, bytes and database queries, for one request. Phases nest, and are
+exclusive: time in an inner phase (e.g. 'query', inside 'save') is not
+counted in the outer phase. So phase durations add up to, at most, the
+total.
+
+Phases recorded,
+
+    download    'validate' (conditional GET), 'serialize', 'fetch'
+                (reading rows, building objects), 'encode', 'compress'
+    upload      'parse', 'build' (model instances), 'save', and, for
+                pipelined uploads, 'wait' (the writer waiting for the
+                parser; 'parse' then runs alongside the other phases)
+    both        'query' (in database execute calls), 'total'
+
+TimingMixin adds timing to a view. When the request ends, timings are
+set as a Server-Timing header, sent by the 'request_timed' signal, and
+logged (logger 'updownrecord.instrumentation', level INFO, with the
+timings dict as 'timings' on the log record). For a streamed response,
+the header holds timings up to the start of the response, and the
+signal and log follow the end of the stream.
+'''
+logger = logging.getLogger('updownrecord.instrumentation')
+
+# sent with sender=view class, request=, timings=
+request_timed = Signal()
+
+
+
+class Timings():
+    '''
+    Phase durations (seconds) and counts for one request.
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.rows = 0
+        self.bytes = 0
+        self.queries = 0
+        self.total = 0.0
+        # open phases, [name, start, time in inner phases]
+        self._open = []
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def start(self, name):
+        self._open.append([name, perf_counter(), 0.0])
+
+    def stop(self):
+        name, start, inner = self._open.pop()
+        elapsed = perf_counter() - start
+        self.add(name, elapsed - inner)
+        if (self._open):
+            self._open[-1][2] += elapsed
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def timed_iter(self, iterable, name):
+        '''
+        Iterate, timing each step in a phase.
+        '''
+        it = iter(iterable)
+        while (True):
+            self.start(name)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield item
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        self.queries += 1
+        with self.phase('query'):
+            return execute(sql, params, many, context)
+
+    @contextlib.contextmanager
+    def count_queries(self):
+        '''
+        Count, and time, queries on all database connections (of this
+        thread) while open.
+        '''
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self.execute_wrapper))
+            yield self
+
+    def as_dict(self):
+        return {
+            'phases': dict(self.phases),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'queries': self.queries,
+            'total': self.total,
+        }
+
+    def server_timing(self):
+        '''
+        @return a Server-Timing header value. Durations are in ms.
+        Counts are metrics with a description only.
+        '''
+        metrics = ['{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in self.phases.items()]
+        metrics.append('total;dur={:.2f}'.format(self.total * 1000))
+        metrics.append('rows;desc={}'.format(self.rows))
+        metrics.append('bytes;desc={}'.format(self.bytes))
+        metrics.append('queries;desc={}'.format(self.queries))
+        return ', '.join(metrics)
+
+    def __str__(self):
+        phases = ' '.join('{}:{:.1f}ms'.format(name, seconds * 1000) for name, seconds in self.phases.items())
+        return '{} total:{:.1f}ms rows:{} bytes:{} queries:{}'.format(
+            phases,
+            self.total * 1000,
+            self.rows,
+            self.bytes,
+            self.queries
+        )
+
+
+
+class TimingMixin():
+    '''
+    Time requests to a view, if 'instrument = True'.
+
+    The Timings object is self.timings while the request runs, for the
+    view code to record phases and counts. When instrument is False,
+    self.timings is None, and nothing is recorded.
+    '''
+    instrument = False
+    timings = None
+
+    def phase(self, name):
+        '''
+        @return a context timing a phase, or doing nothing if not
+        instrumented
+        '''
+        if (self.timings is None):
+            return contextlib.nullcontext()
+        return self.timings.phase(name)
+
+    def dispatch(self, request, *args, **kwargs):
+        if (not self.instrument):
+            return super().dispatch(request, *args, **kwargs)
+        timings = self.timings = Timings()
+        start = perf_counter()
+        with timings.count_queries():
+            response = super().dispatch(request, *args, **kwargs)
+        timings.total = perf_counter() - start
+        response['Server-Timing'] = timings.server_timing()
+        # a file response is complete (and may go to wsgi.file_wrapper)
+        if (response.streaming and getattr(response, 'file_to_stream', None) is None):
+            response.streaming_content = self.timed_stream(response.streaming_content, request, start)
+        else:
+            self.timings_done(request)
+        return response
+
+    def timed_stream(self, chunks, request, start):
+        timings = self.timings
+        with timings.count_queries():
+            yield from chunks
+        timings.total = perf_counter() - start
+        self.timings_done(request)
+
+    def timings_done(self, request):
+        '''
+        Publish the timings of a finished request.
+        '''
+        request_timed.send(sender=self.__class__, request=request, timings=self.timings)
+        logger.info(
+            '%s %s %s',
+            request.method,
+            request.path,
+            self.timings,
+            extra={'timings': self.timings.as_dict()}
+        )
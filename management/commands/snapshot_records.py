@@ -0,0 +1,46 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from ...snapshots import write_snapshot
+from ...views import FORMAT_MAP
+
+
+
+class Command(BaseCommand):
+    help = 'Write export snapshots of models, for DownloadRecordView to serve.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='+', help='models, as app_label.ModelName')
+        parser.add_argument('--format', dest='formats', action='append', required=True,
+            help='format to write (repeat for several)')
+        parser.add_argument('--dir', dest='directory', default=None,
+            help='snapshot directory (default, the UPDOWNRECORD_SNAPSHOT_DIR setting)')
+        parser.add_argument('--use-values', action='store_true',
+            help="serialize through values_list() (the 'nonrel_*' serializers)")
+
+    def handle(self, *args, **options):
+        for label in options['models']:
+            try:
+                model_class = apps.get_model(label)
+            except (LookupError, ValueError):
+                raise CommandError('Unknown model: {}'.format(label))
+            for format in options['formats']:
+                serializer_data = FORMAT_MAP.get(format)
+                if (serializer_data is None):
+                    raise CommandError('Unknown format: {}'.format(format))
+                serializer_options = {}
+                if (serializer_data.requires_model):
+                    serializer_options['model_class'] = model_class
+                if (options['use_values'] and format.startswith('nonrel_')):
+                    serializer_options['use_values'] = True
+                start = time.perf_counter()
+                path = write_snapshot(model_class, format, options['directory'], serializer_options=serializer_options)
+                if (options['verbosity'] > 0):
+                    self.stdout.write('{} {}: {} ({:.2f}s)'.format(
+                        model_class._meta.label,
+                        format,
+                        path,
+                        time.perf_counter() - start
+                    ))
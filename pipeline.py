@@ -0,0 +1,180 @@
+import queue
+import threading
+from time import perf_counter
+
+from django.db import connections
+
+
+'''
+Pipelined uploads.
+
+A parser thread iterates deserialized objects (parsing the upload and
+building model instances), gathers them into batches, and puts the
+batches on a bounded queue. A writer, in the calling thread, takes
+batches from the queue and saves them. So parsing runs while the
+database works on the previous batch.
+
+The queue holds at most queue_size batches. If the writer falls
+behind, the parser waits (backpressure), so memory use is bounded by
+(queue_size + 2) batches.
+
+If the parser raises, the exception is raised in the writer thread
+after the batches parsed before the error are written. If the writer
+raises, the parser is stopped, and the exception raised. Either way the
+parser thread has ended by the time run() returns or raises. Run a
+pipeline in a transaction if a failure should write nothing.
+
+Database writes stay in the calling thread, so they are in the
+caller's connection and transaction. The parser should not need the
+database (the non-relational deserializers do not).
+'''
+# put() timeout, so a blocked parser sees a stop
+POLL_INTERVAL = 0.1
+
+
+
+class PipelineStats():
+    '''
+    Timings of a pipeline run, in seconds.
+
+    parse           parser thread, making objects
+    parse_wait      parser thread, waiting on a full queue (the writer
+                    is the bottleneck)
+    write           writer, saving batches
+    write_wait      writer, waiting on an empty queue (the parser is the
+                    bottleneck)
+    total           the run
+    '''
+    def __init__(self):
+        self.batches = 0
+        self.objects = 0
+        self.parse = 0.0
+        self.parse_wait = 0.0
+        self.write = 0.0
+        self.write_wait = 0.0
+        self.total = 0.0
+
+    def as_dict(self):
+        return {
+            'batches': self.batches,
+            'objects': self.objects,
+            'parse': self.parse,
+            'parse_wait': self.parse_wait,
+            'write': self.write,
+            'write_wait': self.write_wait,
+            'total': self.total,
+        }
+
+    def __str__(self):
+        return 'PipelineStats(batches:{batches}, objects:{objects}, parse:{parse:.3f}s, parse_wait:{parse_wait:.3f}s, write:{write:.3f}s, write_wait:{write_wait:.3f}s, total:{total:.3f}s)'.format(
+            **self.as_dict()
+        )
+
+
+
+class Pipeline():
+    '''
+    Overlap making objects and writing them.
+
+        pipeline = Pipeline(objects, write, batch_size=500)
+        pipeline.run()
+        print(pipeline.stats)
+
+    @param objects iterable of objects. Iterated in the parser thread.
+    @param write callable given each batch (a list of objects), in order
+    @param batch_size objects per batch
+    @param queue_size batches waiting for the writer, at most
+    '''
+    def __init__(self, objects, write, batch_size=500, queue_size=4):
+        if (batch_size < 1 or queue_size < 1):
+            raise ValueError('Pipeline batch_size and queue_size must be positive. batch_size:{} queue_size:{}'.format(
+                batch_size,
+                queue_size
+            ))
+        self.objects = objects
+        self.write = write
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.error = None
+        self.stats = PipelineStats()
+
+    def put(self, item):
+        '''
+        Put on the queue, waiting while full.
+        @return False if the pipeline was stopped while waiting
+        '''
+        start = perf_counter()
+        try:
+            while (not self.stop.is_set()):
+                try:
+                    self.queue.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.stats.parse_wait += perf_counter() - start
+
+    def parse(self):
+        '''
+        Parser thread. Puts batches, then None at the end, or after an
+        error.
+        '''
+        stats = self.stats
+        batch = []
+        try:
+            start = perf_counter()
+            for obj in self.objects:
+                batch.append(obj)
+                if (len(batch) >= self.batch_size):
+                    stats.parse += perf_counter() - start
+                    if (not self.put(batch)):
+                        return
+                    batch = []
+                    start = perf_counter()
+                if (self.stop.is_set()):
+                    return
+            stats.parse += perf_counter() - start
+            if (batch):
+                self.put(batch)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.put(None)
+            # release a part-read source (e.g. a process pool)
+            close = getattr(self.objects, 'close', None)
+            if (close is not None):
+                close()
+            # connections are per thread
+            connections.close_all()
+
+    def run(self):
+        '''
+        Run the pipeline, writing in this thread.
+        @return the stats
+        '''
+        stats = self.stats
+        start = perf_counter()
+        parser = threading.Thread(target=self.parse, name='updownrecord-pipeline-parser', daemon=True)
+        parser.start()
+        try:
+            while (True):
+                wait_start = perf_counter()
+                batch = self.queue.get()
+                write_start = perf_counter()
+                stats.write_wait += write_start - wait_start
+                if (batch is None):
+                    break
+                self.write(batch)
+                stats.write += perf_counter() - write_start
+                stats.batches += 1
+                stats.objects += len(batch)
+        finally:
+            # on a writer error, unblock and end the parser
+            self.stop.set()
+            parser.join()
+            stats.total = perf_counter() - start
+        if (self.error is not None):
+            raise self.error
+        return stats
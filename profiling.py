@@ -0,0 +1,185 @@
+import os
+import re
+import hmac
+import time
+import cProfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+'''
+Opt-in profiling of single requests.
+
+Profiling is off unless settings name a directory and a token,
+
+    UPDOWNRECORD_PROFILE_DIR = '/var/tmp/updownrecord-profiles'
+    UPDOWNRECORD_PROFILE_TOKEN = 'a long random string'
+    # optional, 'cprofile' (default) or 'pyinstrument' (sampling)
+    UPDOWNRECORD_PROFILER = 'cprofile'
+
+Then a request carrying the token, as a query parameter or a header,
+
+    /firework/download/?profile=<token>
+    X-Profile-Token: <token>
+
+runs under the profiler. Stats are written to the directory, named for
+the view, format and row count, e.g.
+'DownloadRecordView-nonrel_csv-25000rows-20240105T101502123-4242.prof'
+(time to the ms, then the process id).
+cProfile output loads with pstats (or snakeviz...). pyinstrument output
+is an HTML page. The response carries the file name in an
+'X-Profile-File' header, except a streamed response, which is profiled,
+and written, as the stream is consumed.
+
+Rows are counted as for 'instrument' (see instrumentation), which is
+switched on for a profiled request.
+
+When profiling is off, a request costs one settings lookup.
+'''
+PROFILE_PARAM = 'profile'
+PROFILE_HEADER = 'HTTP_X_PROFILE_TOKEN'
+
+unsafeRE = re.compile(r'[^\w.-]')
+
+
+
+class CProfiler():
+    extension = 'prof'
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def save(self, path):
+        self.profiler.dump_stats(path)
+
+
+
+class SamplingProfiler():
+    '''
+    pyinstrument, a statistical profiler. Lower overhead than cProfile,
+    so closer to unprofiled timings.
+    '''
+    extension = 'html'
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImproperlyConfigured("UPDOWNRECORD_PROFILER = 'pyinstrument' requires the pyinstrument module.")
+        self.profiler = Profiler()
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.profiler.output_html())
+
+
+PROFILERS = {
+    'cprofile': CProfiler,
+    'pyinstrument': SamplingProfiler,
+}
+
+
+def get_profiler():
+    name = getattr(settings, 'UPDOWNRECORD_PROFILER', 'cprofile')
+    try:
+        return PROFILERS[name]()
+    except KeyError:
+        raise ImproperlyConfigured("UPDOWNRECORD_PROFILER must be one of {}. UPDOWNRECORD_PROFILER:'{}'".format(
+            ', '.join(PROFILERS),
+            name
+        ))
+
+
+def profile_requested(request):
+    '''
+    @return True if the request carries the profiling token
+    '''
+    token = getattr(settings, 'UPDOWNRECORD_PROFILE_TOKEN', None)
+    if (not token):
+        return False
+    given = request.GET.get(PROFILE_PARAM) or request.META.get(PROFILE_HEADER)
+    if (not given):
+        return False
+    return hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8'))
+
+
+
+class ProfilingMixin():
+    '''
+    Profile a request to a view, if settings enable it and the request
+    carries the token. Place before TimingMixin.
+    '''
+    def profile_format(self):
+        return getattr(self, 'format', None)
+
+    def dispatch(self, request, *args, **kwargs):
+        profile_dir = getattr(settings, 'UPDOWNRECORD_PROFILE_DIR', None)
+        if (not profile_dir or not profile_requested(request)):
+            return super().dispatch(request, *args, **kwargs)
+        # count rows
+        self.instrument = True
+        profiler = get_profiler()
+        profiler.start()
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+        finally:
+            profiler.stop()
+        # a file response is complete (and may go to wsgi.file_wrapper)
+        if (response.streaming and getattr(response, 'file_to_stream', None) is None):
+            # rows are known, and the file written, at the end
+            response.streaming_content = self.profiled_stream(response.streaming_content, profiler, profile_dir)
+        else:
+            path = self.save_profile(profiler, profile_dir)
+            response['X-Profile-File'] = os.path.basename(path)
+        return response
+
+    def profiled_stream(self, chunks, profiler, profile_dir):
+        it = iter(chunks)
+        while (True):
+            profiler.start()
+            try:
+                chunk = next(it, None)
+            finally:
+                profiler.stop()
+            if (chunk is None):
+                break
+            yield chunk
+        self.save_profile(profiler, profile_dir)
+
+    def profile_path(self, profile_dir, extension):
+        timings = getattr(self, 'timings', None)
+        rows = timings.rows if (timings is not None) else 0
+        now = time.time()
+        name = '{}-{}-{}rows-{}{:03d}-{}.{}'.format(
+            self.__class__.__name__,
+            self.profile_format() or 'unknown',
+            rows,
+            time.strftime('%Y%m%dT%H%M%S', time.localtime(now)),
+            int(now * 1000) % 1000,
+            os.getpid(),
+            extension
+        )
+        return os.path.join(profile_dir, unsafeRE.sub('_', name))
+
+    def save_profile(self, profiler, profile_dir):
+        '''
+        Write profile stats.
+        @return the path written
+        '''
+        os.makedirs(profile_dir, exist_ok=True)
+        path = self.profile_path(profile_dir, profiler.extension)
+        profiler.save(path)
+        return path
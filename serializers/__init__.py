@@ -5,7 +5,9 @@ To add the serialisers for general use, add this to the settings file::
         "nonrel_csv": "updownrecord.serializers.csv",
         "nonrel_freecfg": "updownrecord.serializers.freecfg",
         "nonrel_json": "updownrecord.serializers.json",
+        "nonrel_jsonl": "updownrecord.serializers.jsonl",
         "nonrel_xml": "updownrecord.serializers.xml",
+        "nonrel_columnar": "updownrecord.serializers.columnar",
     }
 
 Now you can use code like,
@@ -15,4 +17,13 @@ data = serializers.serialize('nonrel_freecfg', SomeModel.objects.all())
 
 for o in serializers.deserialize("nonrel_freecfg", data):
     print(str(o.object))
+
+The non-relational serializers take an opt-in fast path for querysets,
+'use_values=True'. Rows are read with values_list().iterator(), and 
+mapped to output by per-field converters, so no model instances are 
+built. Output is identical. Models with relational or file fields, or
+natural primary keys, use the ordinary path. 'values_chunk_size' sets 
+the iterator chunk size (default 2000).
+
+data = serializers.serialize('nonrel_csv', SomeModel.objects.all(), model_class=SomeModel, use_values=True)
 """
@@ -0,0 +1,369 @@
+import io
+import sys
+import json
+import struct
+from array import array
+
+from django.core.serializers import base
+from django.db import DEFAULT_DB_ALIAS
+
+from .nonrelational_base import NonrelationalSerializer, NonrelationalDeserializer
+from .plans import get_plan, value_to_string_converter
+
+
+'''
+A binary, columnar format, for transfers between Django installations.
+
+A file is,
+
+    magic                b'UDRC\x01'
+    schema length        uint32
+    schema               UTF-8 JSON, {model:, pk:, fields:, row_group_size:}
+                         pk and each field are {name:, type:}
+    row groups...
+    end                  uint32 0
+
+A row group is a row count (uint32), then a block for the pk column
+and for each field, in schema order. A block is a null bitmap (one bit
+per row, set for None), then the values,
+
+    'i'   int64 array (integers)
+    'f'   float64 array (floats)
+    'b'   one byte per row (booleans)
+    's'   uint32 array of lengths, then the UTF-8 text (anything else,
+          as value_to_string())
+
+Integer, float and boolean values are written and read as they are,
+with no conversion through text. Other values go through
+value_to_string() and to_python(), as the text formats. Numbers are
+little-endian. Null slots hold 0 or ''.
+
+Serialization and deserialization work a row group at a time, so
+memory use is one row group.
+'''
+MAGIC = b'UDRC\x01'
+
+INT_TYPES = {
+    'AutoField', 'BigAutoField', 'SmallAutoField',
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'PositiveBigIntegerField',
+}
+FLOAT_TYPES = {'FloatField'}
+BOOL_TYPES = {'BooleanField', 'NullBooleanField'}
+
+# array typecodes with 8-byte items
+INT_CODE = 'q'
+FLOAT_CODE = 'd'
+SWAP = (sys.byteorder == 'big')
+
+uint32 = struct.Struct('<I')
+
+
+
+def column_type(field):
+    '''
+    @return the column type of a field
+    '''
+    internal_type = field.get_internal_type()
+    if (internal_type in INT_TYPES):
+        return 'i'
+    if (internal_type in FLOAT_TYPES):
+        return 'f'
+    if (internal_type in BOOL_TYPES):
+        return 'b'
+    return 's'
+
+
+def null_bitmap(values):
+    bitmap = bytearray((len(values) + 7) >> 3)
+    for i, value in enumerate(values):
+        if (value is None):
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return bitmap
+
+
+def number_block(code, values):
+    a = array(code, [0 if (v is None) else v for v in values])
+    if (SWAP):
+        a.byteswap()
+    return a.tobytes()
+
+
+def encode_column(ctype, values):
+    '''
+    @return the block for a column of values, as a list of bytes
+    '''
+    b = [null_bitmap(values)]
+    if (ctype == 'i'):
+        b.append(number_block(INT_CODE, values))
+    elif (ctype == 'f'):
+        b.append(number_block(FLOAT_CODE, values))
+    elif (ctype == 'b'):
+        b.append(bytes(1 if v else 0 for v in values))
+    else:
+        data = [b'' if (v is None) else v.encode('utf-8') for v in values]
+        lengths = array('I', [len(d) for d in data])
+        if (SWAP):
+            lengths.byteswap()
+        b.append(lengths.tobytes())
+        b.extend(data)
+    return b
+
+
+
+class Serializer(NonrelationalSerializer):
+    """
+    Serialize to the binary columnar format.
+
+    Objects must all be of one model. Output is bytes.
+    """
+    internal_use_only = False
+    stream_class = io.BytesIO
+    row_group_size = 4096
+
+    def prepare(self, stream, fields, use_natural_primary_keys, options):
+        if ('row_group_size' in options):
+            self.row_group_size = options.pop('row_group_size')
+        super().prepare(stream, fields, use_natural_primary_keys, options)
+
+    def drain(self):
+        # output is bytes already
+        value = self.stream.getvalue()
+        self.stream.seek(0)
+        self.stream.truncate()
+        return value
+
+    def start_serialization(self):
+        self.schema_plan = None
+        self.columns = None
+        self.rows = 0
+
+    def end_serialization(self):
+        if (self.schema_plan is None):
+            # no objects
+            self.write_schema(None)
+        self.flush()
+        self.stream.write(uint32.pack(0))
+
+    def write_schema(self, plan):
+        '''
+        Write the file header, and set up columns for the plan.
+        '''
+        self.schema_plan = plan
+        if (plan is None):
+            schema = {'model': None, 'pk': None, 'fields': []}
+            self.column_fields = ()
+        else:
+            schema = {
+                'model': plan.model_path,
+                'pk': {'name': plan.pk.name, 'type': column_type(plan.pk)},
+                'fields': [{'name': f.name, 'type': column_type(f)} for f in plan.fields],
+            }
+            self.column_fields = (plan.pk,) + plan.fields
+        self.column_types = [column_type(f) for f in self.column_fields]
+        schema['row_group_size'] = self.row_group_size
+        data = json.dumps(schema).encode('utf-8')
+        self.stream.write(MAGIC)
+        self.stream.write(uint32.pack(len(data)))
+        self.stream.write(data)
+        self.columns = [[] for _ in self.column_types]
+
+    def use_plan(self, plan):
+        if (self.schema_plan is None):
+            self.write_schema(plan)
+        elif (plan is not self.schema_plan):
+            raise base.SerializationError("Columnar serializer handling model {} recieved an object of model {}".format(
+                self.schema_plan.model_path,
+                plan.model_path
+            ))
+
+    def flush(self):
+        '''
+        Write the gathered rows as a row group.
+        '''
+        if (not self.rows):
+            return
+        b = [uint32.pack(self.rows)]
+        for ctype, values in zip(self.column_types, self.columns):
+            b.extend(encode_column(ctype, values))
+        self.stream.write(b''.join(b))
+        self.columns = [[] for _ in self.column_types]
+        self.rows = 0
+
+    def end_row(self):
+        self.rows += 1
+        if (self.rows >= self.row_group_size):
+            self.flush()
+
+    ## model instances
+    def start_object(self, obj):
+        self.verify_object_is_model(obj)
+        self._current = obj
+
+    def handle_field(self, obj, field):
+        pass
+
+    def end_object(self, obj):
+        # the plan is known only after start_object(), so the row is
+        # gathered here
+        self.use_plan(self.plan)
+        for column, ctype, field in zip(self.columns, self.column_types, self.column_fields):
+            value = field.value_from_object(obj)
+            if (ctype == 's' and value is not None):
+                value = field.value_to_string(obj)
+            column.append(value)
+        self.end_row()
+
+    ## values()
+    def value_converter(self, field):
+        if (column_type(field) != 's'):
+            return None
+        to_string = value_to_string_converter(field)
+        def convert(value):
+            return None if (value is None) else to_string(value)
+        return convert
+
+    def handle_row(self, model_path, pk, fields, values):
+        self.use_plan(self.plan)
+        columns = self.columns
+        columns[0].append(pk)
+        for column, value in zip(columns[1:], values):
+            column.append(value)
+        self.end_row()
+
+
+
+class Deserializer(NonrelationalDeserializer):
+    """
+    Deserialize the binary columnar format, a row group at a time.
+    """
+    def __init__(self, stream_or_string, *, using=DEFAULT_DB_ALIAS, ignorenonexistent=False, **options):
+        super().__init__(stream_or_string, **options)
+        self.db = using
+        self.ignore = ignorenonexistent
+        self.read_schema()
+        self.rows = iter(())
+
+    def text_stream(self, stream_or_string):
+        # binary, so not decoded
+        if isinstance(stream_or_string, str):
+            raise base.DeserializationError("Columnar data must be bytes, not text")
+        if isinstance(stream_or_string, (bytes, bytearray)):
+            return io.BytesIO(stream_or_string)
+        return stream_or_string
+
+    def read_exact(self, size):
+        data = self.stream.read(size)
+        while (len(data) < size):
+            more = self.stream.read(size - len(data))
+            if (not more):
+                raise base.DeserializationError("Columnar data is truncated")
+            data += more
+        return data
+
+    def read_schema(self):
+        if (self.read_exact(len(MAGIC)) != MAGIC):
+            raise base.DeserializationError("Data is not in the columnar format (or is a later version)")
+        size, = uint32.unpack(self.read_exact(4))
+        schema = json.loads(self.read_exact(size).decode('utf-8'))
+        self.schema = schema
+        self.column_types = []
+        self.targets = []
+        if (schema['model'] is None):
+            self.model_class = None
+            return
+        self.model_path = schema['model']
+        self.model_class = self.get_model_class(self.model_path)
+        plan = get_plan(self.model_class)
+        self.pk_field = plan.pk
+        self.column_types.append(schema['pk']['type'])
+        # Resolve the columns to fields once. Each target is
+        # (data key, converter), None for a skipped column.
+        for column in schema['fields']:
+            self.column_types.append(column['type'])
+            name = column['name']
+            if self.ignore and name not in plan.name_set:
+                self.targets.append(None)
+                continue
+            field = plan.get_field(name)
+            if (not self.field_is_nonrelational(self.ignore, self.model_class, field)):
+                self.targets.append(None)
+                continue
+            self.targets.append((field.name, field.to_python if (column['type'] == 's') else None))
+
+    def read_column(self, ctype, count):
+        '''
+        @return a list of the values of a column block
+        '''
+        bitmap = self.read_exact((count + 7) >> 3)
+        if (ctype == 'i' or ctype == 'f'):
+            a = array(INT_CODE if (ctype == 'i') else FLOAT_CODE)
+            a.frombytes(self.read_exact(count * 8))
+            if (SWAP):
+                a.byteswap()
+            values = a.tolist()
+        elif (ctype == 'b'):
+            values = [b != 0 for b in self.read_exact(count)]
+        elif (ctype == 's'):
+            lengths = array('I')
+            lengths.frombytes(self.read_exact(count * 4))
+            if (SWAP):
+                lengths.byteswap()
+            data = self.read_exact(sum(lengths))
+            values = []
+            pos = 0
+            for length in lengths:
+                values.append(data[pos:pos + length].decode('utf-8'))
+                pos += length
+        else:
+            raise base.DeserializationError("Unknown columnar column type: '{}'".format(ctype))
+        if (any(bitmap)):
+            for i in range(count):
+                if (bitmap[i >> 3] & (1 << (i & 7))):
+                    values[i] = None
+        return values
+
+    def read_row_group(self):
+        '''
+        @return an iterator of the rows of the next row group, or None
+        at the end of the data
+        '''
+        count, = uint32.unpack(self.read_exact(4))
+        if (count == 0):
+            return None
+        columns = [self.read_column(ctype, count) for ctype in self.column_types]
+        return zip(*columns)
+
+    def __next__(self):
+        row = next(self.rows, None)
+        while (row is None):
+            rows = self.read_row_group() if (self.model_class is not None) else None
+            if (rows is None):
+                raise StopIteration
+            self.rows = rows
+            row = next(self.rows, None)
+        model_class = self.model_class
+        data = {}
+        pk = row[0]
+        if (pk is not None):
+            try:
+                data[model_class._meta.pk.attname] = self.pk_to_python(model_class, pk)
+            except Exception as e:
+                raise base.DeserializationError.WithData(e, self.model_path, pk, None)
+        for target, value in zip(self.targets, row[1:]):
+            if (target is None):
+                continue
+            name, to_python = target
+            if (to_python is not None and value is not None):
+                try:
+                    value = to_python(value)
+                except Exception as e:
+                    raise base.DeserializationError("{}: ({}:pk={}) field:'{}': field_value:'{}'".format(
+                        e,
+                        self.model_path,
+                        pk,
+                        name,
+                        value
+                    ))
+            data[name] = value
+        return self.build_object(model_class, data)
@@ -1,31 +1,47 @@
+import io
+import os
 import csv
+import mmap
 
+from django.apps import apps
+from django.core.serializers import base
 from django.db import DEFAULT_DB_ALIAS
 from django.core.exceptions import ImproperlyConfigured
 
 from .nonrelational_python import NonrelationalSerializer, NonrelationalDeserializer
+from .plans import get_plan, to_python_converter
+from .parallel import spooled_path, record_end, record_ranges, iter_parallel
 
 
 class Serializer(NonrelationalSerializer):
     dialect='excel'
     model_class = None
         
-    def serialize(self, queryset, *args, stream=None, fields=None, model_class=None,
-                  use_natural_primary_keys=False, progress_output=None, object_count=0, **options):
+    def set_model_class(self, model_class):
         if (model_class is not None): 
             self.model_class = model_class
         if (self.model_class is None): 
             raise ImproperlyConfigured('CSV Serializer must have a "model_class" attibute.')  
         #! test is model
+        
+    def serialize(self, queryset, *args, stream=None, fields=None, model_class=None,
+                  use_natural_primary_keys=False, progress_output=None, object_count=0, **options):
+        self.set_model_class(model_class)
         return super().serialize(queryset, *args, stream=stream, fields=fields,
                   use_natural_primary_keys=use_natural_primary_keys, progress_output=progress_output, object_count=object_count, **options)
 
+    def serialize_iter(self, queryset, *args, fields=None, model_class=None,
+                  use_natural_primary_keys=False, chunk_size=None, **options):
+        self.set_model_class(model_class)
+        return super().serialize_iter(queryset, *args, fields=fields,
+                  use_natural_primary_keys=use_natural_primary_keys, chunk_size=chunk_size, **options)
+
     def start_serialization(self):
         """
         Start serialization -- open the XML document and the root element.
         """
         fieldnames = ['pk']
-        fieldnames.extend(self.field_names(self.model_class))
+        fieldnames.extend(self.get_plan(self.model_class).names)
         self.writer = csv.DictWriter(self.stream, fieldnames=fieldnames, dialect=self.dialect)
         self.writer.writeheader()
 
@@ -39,11 +55,19 @@ class Serializer(NonrelationalSerializer):
     def end_object(self, obj):
         # test object is the model_class
         self.verify_object_from_model_class(self.model_class, obj)
-        d = self.get_dump_object(obj)
+        super().end_object(obj)
+
+    def end_record(self, d):
         obj_dict = d['fields']
         obj_dict['pk'] = d['pk']
         self.writer.writerow(obj_dict)
 
+    def values_plan(self, queryset):
+        if (getattr(queryset, 'model', None) != self.model_class):
+            # leave the error to the instance path
+            return None
+        return super().values_plan(queryset)
+
     def getvalue(self):
         # Grandparent super
         return super(NonrelationalSerializer, self).getvalue()
@@ -51,11 +75,26 @@ class Serializer(NonrelationalSerializer):
 
 
 class Deserializer(NonrelationalDeserializer):
+    """
+    Deserialize CSV.
+
+    Columns are fixed by the header, so are resolved to fields once, 
+    as a tuple of (name, converter), and rows from csv.reader are 
+    converted by position.
+
+    With 'workers' above 1, and input which is a file on disk (e.g. a 
+    spooled upload), the file is split into record-aligned byte ranges
+    of about 'range_size', which are parsed and converted in a pool of
+    'workers' processes. Objects are built in the calling process, in
+    file order, so results are as serial parsing. Other input is 
+    parsed serially. 
+    """
     dialect = 'excel'
     has_header = True
     model_class = None
+    range_size = 4 * 1024 * 1024
     
-    def __init__(self, stream_or_string, *args, using=DEFAULT_DB_ALIAS, model_class=None, ignorenonexistent=False, dialect=False, has_header=True, **options):
+    def __init__(self, stream_or_string, *args, using=DEFAULT_DB_ALIAS, model_class=None, ignorenonexistent=False, dialect=False, has_header=True, workers=None, range_size=None, **options):
         if (model_class is not None): 
             self.model_class = model_class
         if (self.model_class is None): 
@@ -63,27 +102,175 @@ class Deserializer(NonrelationalDeserializer):
         self.model_path = str(self.model_class._meta)
         if (dialect):
             self.dialect = dialect
-        if (has_header):
-            self.has_header = has_header
-        #? Mobe this shit to nonrel base
-        #? encode with optional encoding
-   
+        self.has_header = has_header
+        if (range_size):
+            self.range_size = range_size
+        self.path = None
+        if (workers and workers > 1):
+            self.path = spooled_path(stream_or_string)
+        self.workers = workers
+        self.rows = None
         super().__init__(stream_or_string, *args, using=using, ignorenonexistent=ignorenonexistent, **options)
 
     def get_object_list(self, stream):
+        return csv.reader(self.stream, dialect=self.dialect)
+
+    def column_names(self):
         if(self.has_header):
-            return csv.DictReader(self.stream, dialect=self.dialect)
+            # blank lines before the header are skipped
+            for row in self.data_it:
+                if (row):
+                    return row
+            return []
+        return self.default_column_names()
+
+    def default_column_names(self):
+        field_names = list(get_plan(self.model_class).names)
+        field_names.append('pk')
+        return field_names
+
+    def compile_columns(self, names):
+        """
+        Resolve column names to (field name, converter) pairs, None 
+        for a column which is not loaded (including 'pk'). 
+        """
+        model_class = self.model_class
+        plan = get_plan(model_class)
+        columns = []
+        self.pk_index = None
+        for i, name in enumerate(names):
+            if (name == 'pk'):
+                self.pk_index = i
+                columns.append(None)
+                continue
+            if self.ignore and name not in plan.name_set:
+                columns.append(None)
+                continue
+            field = plan.get_field(name)
+            # Do not handle relation fields.
+            if (self.field_is_nonrelational(self.ignore, model_class, field)):
+                columns.append((field.name, to_python_converter(field)))
+            else:
+                columns.append(None)
+        return tuple(columns)
+
+    def set_columns(self, names):
+        self.names = names
+        self.columns = self.compile_columns(names)
+
+    def __next__(self):
+        if (self.rows is None):
+            self.rows = self.parallel_rows() if (self.path is not None) else self.serial_rows()
+        data = next(self.rows)
+        return self.build_object(self.model_class, data)
+
+    def serial_rows(self):
+        """
+        @return generator of the data of each row
+        """
+        self.set_columns(self.column_names())
+        for row in self.data_it:
+            # as DictReader, blank lines are skipped
+            if (row):
+                yield self.row_data(row)
+
+    def parallel_rows(self):
+        """
+        @return generator of the data of each row, parsed in a 
+        process pool
+        """
+        start = 0
+        if (self.has_header):
+            names, start = self.read_header()
         else:
-            field_names = self.field_names(self.model_class)
-            field_names.append('pk')
-            return csv.DictReader(self.stream, fieldnames=field_names, dialect=self.dialect)
+            names = self.default_column_names()
+        # resolve here too, so column errors are raised before any work
+        self.set_columns(names)
+        ranges = record_ranges(self.path, start, self.range_size)
+        options = {
+            'model_path': self.model_path,
+            'names': names,
+            'dialect': self.dialect,
+            'encoding': self.encoding,
+            'ignore': self.ignore,
+        }
+        return iter_parallel(parse_range, self.path, ranges, self.workers, options)
+
+    def read_header(self):
+        """
+        @return (column names, offset of the first record after them)
+        """
+        start = 0
+        with open(self.path, 'rb') as f:
+            if (not os.fstat(f.fileno()).st_size):
+                return ([], start)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while (start < len(m)):
+                    end = record_end(m, start, start)
+                    rows = list(csv.reader(io.StringIO(m[start:end].decode(self.encoding)), dialect=self.dialect))
+                    if (rows and rows[0]):
+                        return (rows[0], end)
+                    start = end
+        return ([], start)
+
+    def row_data(self, row):
+        """
+        @return data for building an instance from a row
+        """
+        columns = self.columns
+        width = len(columns)
+        if (len(row) != width):
+            if (len(row) > width and not self.ignore):
+                raise base.DeserializationError("CSV line {} has more values than the header".format(
+                    self.data_it.line_num
+                ))
+            # short rows are padded with None, as DictReader
+            row = (row + [None] * width)[:width]
+
+        model_class = self.model_class
+        data = {}
+        pk = None if (self.pk_index is None) else row[self.pk_index]
+        if (pk):
+            try:
+                data[model_class._meta.pk.attname] = self.pk_to_python(model_class, pk)
+            except Exception as e:
+                raise base.DeserializationError.WithData(e, self.model_path, pk, None)
+        for column, value in zip(columns, row):
+            if (column is None):
+                continue
+            name, convert = column
+            if (convert is not None):
+                try:
+                    value = convert(value)
+                except Exception as e:
+                    raise base.DeserializationError("{}: ({}:pk={}) field:'{}': field_value:'{}'".format(
+                        e, 
+                        self.model_path, 
+                        pk, 
+                        name,
+                        value
+                    ))
+            data[name] = value
+        return data
+
 
-    def model_path_from_data(self, d):
-        return self.model_path
 
-    def get_pk_from_data(self, d):
-        return d.get('pk')
+def parse_range(path, start, end, options):
+    """
+    Parse a record-aligned byte range of a CSV file (in a pool 
+    worker).
 
-    def fields_from_data(self, d):
-        d.pop('pk')
-        return d
+    @return list of the data of each row
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(options['encoding'])
+    d = Deserializer(
+        text, 
+        model_class=apps.get_model(options['model_path']),
+        dialect=options['dialect'],
+        has_header=False,
+        ignorenonexistent=options['ignore'],
+    )
+    d.set_columns(options['names'])
+    return [d.row_data(row) for row in d.data_it if row]
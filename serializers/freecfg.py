@@ -10,15 +10,12 @@ class Serializer(NonrelationalSerializer):
     def start_serialization(self):
         self.writer = Writer(self.stream)
 
-    def end_object(self, obj):
-        # self._current has the field data
-        # needs to be broken up for freeconfig
-        do = self.get_dump_object(obj)
+    def end_record(self, do):
+        # the dump data needs to be broken up for freeconfig
         self.writer.mksection(do['model'])
         self.writer.mkentry('pk', do['pk'])
         for fname, fval in do['fields'].items():
             self.writer.mkentry(fname, fval)
-        self._current = None
 
     def getvalue(self):
         # Grandparent super
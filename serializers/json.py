@@ -32,8 +32,7 @@ class Serializer(NonrelationalSerializer):
         if self.options.get("indent"):
             self.stream.write("\n")
 
-    def end_object(self, obj):
-        # self._current has the field data
+    def end_record(self, d):
         indent = self.options.get("indent")
         if not self.first:
             self.stream.write(",")
@@ -41,10 +40,7 @@ class Serializer(NonrelationalSerializer):
                 self.stream.write(" ")
         if indent:
             self.stream.write("\n")
-        d = self.get_dump_object(obj)
-
-        json.dump(self.get_dump_object(obj), self.stream, **self.json_kwargs)
-        self._current = None
+        json.dump(d, self.stream, **self.json_kwargs)
 
     def getvalue(self):
         # Grandparent super
@@ -52,9 +48,109 @@ class Serializer(NonrelationalSerializer):
 
 
 
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]'
+
+# Characters a decode error can point back from the end of the text, 
+# when an item is cut short (in a literal, 'fals', a number, '-0.', 
+# or an escape, '\u12'). Strings cut short are reported at their 
+# start, so are found by the message.
+CUT_SHORT_SIZE = 6
+
+def iter_array(stream, read_size=64 * 1024):
+    """
+    Iterate the items of a top-level JSON array, read from a stream.
+
+    The stream is read in blocks, and items are decoded one at a time
+    with JSONDecoder.raw_decode(), so memory use is proportional to
+    the largest item, not the document. Decoding is retried, on a 
+    larger buffer, when an item runs past the text read so far. Other
+    errors are raised at once, as is text after the array.
+
+    @param stream text stream, with a read(size) method
+    @return generator of decoded items
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def more(size=read_size):
+        # drop consumed text, append a block
+        nonlocal buf, pos, eof
+        if (eof):
+            return False
+        text = stream.read(size)
+        if (not text):
+            eof = True
+            return False
+        buf = buf[pos:] + text
+        pos = 0
+        return True
+
+    def next_char():
+        # skip whitespace, return the next character, or '' at EOF
+        nonlocal pos
+        while (True):
+            while (pos < len(buf) and buf[pos] in WHITESPACE):
+                pos += 1
+            if (pos < len(buf)):
+                return buf[pos]
+            if (not more()):
+                return ''
+
+    def cut_short(e):
+        # True if the error may be the end of the text read
+        return (len(buf) - e.pos < CUT_SHORT_SIZE 
+            or e.msg.startswith('Unterminated string'))
+
+    def end_array():
+        # past the closing ']', only whitespace
+        nonlocal pos
+        pos += 1
+        if (next_char() != ''):
+            raise DeserializationError("JSON data continues after the array, at '{}'".format(buf[pos:pos + 20]))
+
+    if (next_char() != '['):
+        raise DeserializationError("JSON data must be an array of objects")
+    pos += 1
+    if (next_char() == ']'):
+        end_array()
+        return
+    while (True):
+        # raw_decode() does not skip leading whitespace
+        next_char()
+        while (True):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                # grow the buffer geometrically, so a long item is not 
+                # re-decoded once per block
+                if (not cut_short(e) or not more(max(read_size, len(buf) - pos))):
+                    raise DeserializationError(e)
+                continue
+            # objects, arrays and strings end at a closing character,
+            # but a number (e.g. '4.5' of '4.5e3') or literal may 
+            # continue past the text read, so must be delimited
+            if (buf[end - 1] in '}]"' 
+                or (end < len(buf) and buf[end] in DELIMITERS) 
+                or not more()):
+                break
+        pos = end
+        yield item
+        c = next_char()
+        if (c == ']'):
+            end_array()
+            return
+        if (c != ','):
+            raise DeserializationError("JSON array items must be separated by ',', at '{}'".format(buf[pos:pos + 20]))
+        pos += 1
+
+
+
 class Deserializer(NonrelationalDeserializer):
     def get_object_list(self, stream):
-        return json.loads(stream.read())
+        return iter_array(stream)
 
     def model_path_from_data(self, d):
         return d['model']
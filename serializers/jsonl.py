@@ -0,0 +1,54 @@
+import json
+
+from django.core.serializers.base import DeserializationError
+
+from .nonrelational_python import NonrelationalDeserializer
+from . import json as json_serializer
+
+
+'''
+JSON Lines (NDJSON).
+
+One object per line, each as the objects of the nonrel JSON array,
+{model: pk: fields:}. With no enclosing array, output can be 
+processed, split and concatenated by line, and the deserializer holds
+one line at a time.
+'''
+class Serializer(json_serializer.Serializer):
+    """Convert a queryset to JSON Lines."""
+    def _init_options(self):
+        super()._init_options()
+        # a record must stay on one line
+        self.json_kwargs.pop('indent', None)
+        self.json_kwargs['separators'] = (', ', ': ')
+
+    def start_serialization(self):
+        self._init_options()
+
+    def end_serialization(self):
+        pass
+
+    def end_record(self, d):
+        json.dump(d, self.stream, **self.json_kwargs)
+        self.stream.write("\n")
+
+
+
+class Deserializer(NonrelationalDeserializer):
+    def get_object_list(self, stream):
+        for lineno, line in enumerate(stream, start=1):
+            if (line.isspace()):
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise DeserializationError("line {}: {}".format(lineno, e))
+
+    def model_path_from_data(self, d):
+        return d['model']
+
+    def get_pk_from_data(self, d):
+        return d.get('pk')
+
+    def fields_from_data(self, d):
+        return d['fields']
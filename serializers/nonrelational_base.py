@@ -1,7 +1,14 @@
 import re
+import io
+import codecs
 
 from django.core.serializers import base
 from django.apps import apps
+from django.db import models
+from django.db.models import QuerySet
+from django.db.models.query import ModelIterable
+
+from .plans import get_plan
 
 
 
@@ -9,6 +16,89 @@ class UnserializableContentError(ValueError):
     pass
     
     
+class DecodedStream():
+    '''
+    Text stream over a byte stream, decoded as it is read.
+    
+    The source is read in blocks of read_size, through an incremental
+    decoder, so multibyte characters split across blocks are handled.
+    Memory use is bounded by the block size (and the longest line, if 
+    read by line). Lines end at '\n', as io.StringIO. A source which 
+    returns text is passed through.
+    
+    Supports read(size), readline() and iteration by line.
+    '''
+    read_size = 64 * 1024
+
+    def __init__(self, stream, encoding, read_size=None):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        if (read_size):
+            self.read_size = read_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        '''
+        Read a block from the source onto the buffer.
+        @return False if the source is exhausted.
+        '''
+        if (self.eof):
+            return False
+        data = self.stream.read(self.read_size)
+        if (not data):
+            text = self.decoder.decode(b'', final=True)
+            self.eof = True
+        elif isinstance(data, str):
+            text = data
+        else:
+            text = self.decoder.decode(data)
+        # drop consumed text
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        if (size is None or size < 0):
+            while (self.fill()):
+                pass
+            size = len(self.buffer) - self.pos
+        while (len(self.buffer) - self.pos < size and self.fill()):
+            pass
+        end = self.pos + size
+        text = self.buffer[self.pos:end]
+        self.pos = min(end, len(self.buffer))
+        return text
+
+    def readline(self):
+        start = self.pos
+        while (True):
+            idx = self.buffer.find('\n', start)
+            if (idx >= 0):
+                end = idx + 1
+                break
+            # search only new text
+            start = len(self.buffer) - self.pos
+            if (not self.fill()):
+                end = len(self.buffer)
+                break
+            start += self.pos
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if (not line):
+            raise StopIteration
+        return line
+
+        
+    
 class UtilityMixin():
     def ensure_string(self, stream_or_string, encoding):
         if not isinstance(stream_or_string, (bytes, str)):
@@ -18,7 +108,7 @@ class UtilityMixin():
         return stream_or_string
          
     def field_names(self, model_class):
-      return {f.name for f in model_class._meta.concrete_model._meta.local_fields if f.serialize}
+      return get_plan(model_class).name_set
 
     def field_type(self, field):
         return field.get_internal_type()
@@ -42,6 +132,13 @@ class NonrelationalSerializer(UtilityMixin, base.Serializer):
     Abstract serializer base class.
     """
     encoding = 'utf-8'
+    # default size of chunks from serialize_iter()
+    chunk_size = 64 * 1024
+    # read querysets through values_list(), not model instances
+    use_values = False
+    values_chunk_size = 2000
+    # an instrumentation.Timings, to record phases and counts
+    timings = None
 
     # some helpers
     def _verify_no_control_characters(self, content):
@@ -82,19 +179,200 @@ class NonrelationalSerializer(UtilityMixin, base.Serializer):
             raise base.SerializationError("Non-model object (%s) encountered during serialization" % type(obj))
 
     ## mechanism
-    def serialize(self, queryset, *args, stream=None, fields=None,
-                  use_natural_primary_keys=False, progress_output=None, object_count=0, **options):
-        # NB: I do not know why the super() call can not do this, but 
-        # it will not. Not in my rig, anyway. This code line replicates 
-        # the super() line from a Django I have downloaded. R.C.
-        stream = stream if stream is not None else self.stream_class()
-        # This is new, an assertion of stringification and decoding.
-        # While expensive, some parsers can not handle byte input.
+    def prepare(self, stream, fields, use_natural_primary_keys, options):
+        """
+        Set the serializer state for a run.
+        """
         if ('encoding' in options):
             self.encoding = options.pop('encoding')
-        string = self.ensure_string(stream, self.encoding)
-        return super().serialize(queryset, *args, stream=stream, fields=fields, use_natural_foreign_keys=False,
-                  use_natural_primary_keys=use_natural_primary_keys, progress_output=progress_output, object_count=object_count, **options)
+        if ('use_values' in options):
+            self.use_values = options.pop('use_values')
+        if ('values_chunk_size' in options):
+            self.values_chunk_size = options.pop('values_chunk_size')
+        if ('timings' in options):
+            self.timings = options.pop('timings')
+        self.options = options
+        self.stream = stream if stream is not None else self.stream_class()
+        self.selected_fields = fields
+        self.use_natural_foreign_keys = False
+        self.use_natural_primary_keys = use_natural_primary_keys
+        
+    def serialize(self, queryset, *args, stream=None, fields=None,
+                  use_natural_primary_keys=False, progress_output=None, object_count=0, **options):
+        # NB: the Django super() does not know of serialize_iter(), so
+        # the loop is replicated here in serialize_objects(). Both 
+        # serialize() and serialize_iter() are driven by it.
+        self.prepare(stream, fields, use_natural_primary_keys, options)
+        progress_bar = self.progress_class(progress_output, object_count)
+        if (self.timings is not None):
+            self.timings.start('serialize')
+        for count in self.serialize_objects(queryset):
+            progress_bar.update(count)
+        if (self.timings is not None):
+            self.timings.stop()
+        return self.getvalue()
+
+    def serialize_iter(self, queryset, *args, fields=None,
+                  use_natural_primary_keys=False, chunk_size=None, **options):
+        """
+        Serialize a queryset as a generator of encoded chunks.
+        
+        Output is written to a buffer which is emptied whenever it
+        holds more than chunk_size characters, so memory use does not 
+        grow with the size of the queryset. QuerySets are read through
+        iterator(), so model instances are not cached either.
+        
+        @param chunk_size approximate size of yielded chunks
+        @return generator of bytes, encoded with self.encoding
+        """
+        self.prepare(None, fields, use_natural_primary_keys, options)
+        if (chunk_size is None):
+            chunk_size = self.chunk_size
+        if isinstance(queryset, QuerySet):
+            queryset = queryset.iterator()
+        timings = self.timings
+        if (timings is None):
+            for count in self.serialize_objects(queryset):
+                if (self.stream.tell() >= chunk_size):
+                    yield self.drain()
+            chunk = self.drain()
+            if (chunk):
+                yield chunk
+            return
+        # time only this generator's work, not the consumer's
+        timings.start('serialize')
+        for count in self.serialize_objects(queryset):
+            if (self.stream.tell() >= chunk_size):
+                chunk = self.drain()
+                timings.bytes += len(chunk)
+                timings.stop()
+                yield chunk
+                timings.start('serialize')
+        chunk = self.drain()
+        timings.bytes += len(chunk)
+        timings.stop()
+        if (chunk):
+            yield chunk
+
+    def drain(self):
+        """
+        Empty the output buffer.
+        @return the buffer contents, encoded.
+        """
+        value = self.stream.getvalue()
+        self.stream.seek(0)
+        self.stream.truncate()
+        if (self.timings is not None):
+            with self.timings.phase('encode'):
+                return value.encode(self.encoding)
+        return value.encode(self.encoding)
+        
+    def serialize_objects(self, queryset):
+        """
+        Run the serialization callbacks over a queryset.
+        
+        The code is Django's base.Serializer.serialize() loop. It yields
+        the count of objects written after each object.
+        """
+        self.start_serialization()
+        self.first = True
+        plan = self.values_plan(queryset) if (self.use_values) else None
+        count = 0
+        if (plan is not None):
+            for count in self.serialize_values(queryset, plan):
+                yield count
+        else:
+            for count in self.serialize_instances(queryset):
+                yield count
+        self.end_serialization()
+        if (self.timings is not None):
+            self.timings.rows += count
+
+    def get_plan(self, model_class):
+        """
+        Return the serialization plan of a model, for the current 
+        field selection.
+        """
+        return get_plan(model_class, self.selected_fields, self.use_natural_primary_keys)
+
+    def fetched(self, iterable):
+        """
+        Return the iterable, timed as the 'fetch' phase if timing.
+        """
+        if (self.timings is None):
+            return iterable
+        return self.timings.timed_iter(iterable, 'fetch')
+
+    def serialize_instances(self, queryset):
+        plan = None
+        for count, obj in enumerate(self.fetched(queryset), start=1):
+            self.start_object(obj)
+            model_class = obj._meta.model
+            if (plan is None or plan.model_class is not model_class):
+                plan = self.get_plan(model_class)
+            self.plan = plan
+            for field in plan.fields:
+                if field.remote_field is None:
+                    self.handle_field(obj, field)
+                else:
+                    self.handle_fk_field(obj, field)
+            for field in plan.many_to_many:
+                self.handle_m2m_field(obj, field)
+            self.end_object(obj)
+            self.first = False
+            yield count
+
+    ## values() path
+    def values_plan(self, queryset):
+        """
+        Return the plan for reading a queryset by values_list(), or 
+        None if the queryset can not be handled that way.
+        """
+        if (not isinstance(queryset, QuerySet) 
+            or not issubclass(queryset._iterable_class, ModelIterable)):
+            return None
+        plan = self.get_plan(queryset.model)
+        if (plan.values_fields is None):
+            return None
+        return plan
+        
+    def serialize_values(self, queryset, plan):
+        """
+        Serialize a queryset from values_list() rows.
+        
+        Columns are mapped through the per-field converters of the 
+        plan, which give the values the model instance path would. 
+        Rows go to handle_row().
+        """
+        self.plan = plan
+        model_path = plan.model_path
+        fields = plan.values_fields
+        pk_converter, converters = plan.converters(self)
+        attnames = [field.attname for field in fields]
+        rows = self.fetched(queryset.values_list('pk', *attnames).iterator(chunk_size=self.values_chunk_size))
+        for count, row in enumerate(rows, start=1):
+            values = [value if (convert is None) else convert(value) for convert, value in zip(converters, row[1:])]
+            pk = row[0] if (pk_converter is None) else pk_converter(row[0])
+            self.handle_row(model_path, pk, fields, values)
+            self.first = False
+            yield count
+
+    def value_converter(self, field):
+        """
+        Return a callable converting a raw column value of the field 
+        to the value the serializer writes, or None if the value is 
+        written as it comes.
+        """
+        raise NotImplementedError('subclasses of NonrelationalSerializer must provide a value_converter() method to use values')
+
+    def pk_converter(self, field):
+        return self.value_converter(field)
+
+    def handle_row(self, model_path, pk, fields, values):
+        """
+        Called to write an object from converted values.
+        """
+        raise NotImplementedError('subclasses of NonrelationalSerializer must provide a handle_row() method to use values')
         
     def handle_fk_field(self, obj, field):
         """
@@ -120,14 +398,37 @@ class NonrelationalSerializer(UtilityMixin, base.Serializer):
 class NonrelationalDeserializer(UtilityMixin, base.Deserializer):
     ignore = False
     encoding = 'utf-8'
+    # an instrumentation.Timings, to record phases
+    timings = None
     
     def __init__(self, stream_or_string, **options):
-        # This is new, an assertion of stringification and decoding.
-        # While expensive, some parsers can not handle byte input.
+        # Input is decoded as it is read (some parsers can not handle 
+        # byte input), so an upload is never held whole.
         if ('encoding' in options):
             self.encoding = options.pop('encoding')
-        string = self.ensure_string(stream_or_string, self.encoding)
-        super().__init__(string, **options)
+        if ('timings' in options):
+            self.timings = options.pop('timings')
+        super().__init__(self.text_stream(stream_or_string), **options)
+
+    def text_stream(self, stream_or_string):
+        """
+        Return a text stream over the input.
+        """
+        if isinstance(stream_or_string, str):
+            return io.StringIO(stream_or_string)
+        if isinstance(stream_or_string, (bytes, bytearray)):
+            stream_or_string = io.BytesIO(stream_or_string)
+        return DecodedStream(stream_or_string, self.encoding)
+
+    def build_object(self, model_class, data):
+        """
+        Build a model instance from field data.
+        @return a DeserializedObject
+        """
+        if (self.timings is None):
+            return base.DeserializedObject(base.build_instance(model_class, data, self.db))
+        with self.timings.phase('build'):
+            return base.DeserializedObject(base.build_instance(model_class, data, self.db))
 
     ## helpers
     def get_model_class(self, model_path):
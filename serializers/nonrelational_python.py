@@ -10,6 +10,7 @@ from django.core.serializers import base
 from django.db import DEFAULT_DB_ALIAS, models
 from django.utils.encoding import is_protected_type
 from updownrecord.serializers import nonrelational_base
+from updownrecord.serializers.plans import get_plan, is_passthrough, value_to_string_converter
 from django.core.serializers.base import DeserializationError
 
 
@@ -37,9 +38,16 @@ class NonrelationalSerializer(nonrelational_base.NonrelationalSerializer):
         self._current = OrderedDict()
 
     def end_object(self, obj):
-        self.objects.append(self.get_dump_object(obj))
+        self.end_record(self.get_dump_object(obj))
         self._current = None
 
+    def end_record(self, data):
+        """
+        Called with the dump data of each object, as built by 
+        get_dump_object().
+        """
+        self.objects.append(data)
+
     def get_dump_object(self, obj):
         data = OrderedDict([('model', self.model_path(obj))])
         if not self.use_natural_primary_keys or not hasattr(obj, 'natural_key'):
@@ -55,7 +63,27 @@ class NonrelationalSerializer(nonrelational_base.NonrelationalSerializer):
         return value if is_protected_type(value) else field.value_to_string(obj)
 
     def handle_field(self, obj, field):
-        self._current[field.name] = self._value_from_field(obj, field)
+        # as _value_from_field(), with the plan's data
+        name = field.name
+        value = field.value_from_object(obj)
+        if (not (self.plan.passthrough[name] or is_protected_type(value))):
+            value = field.value_to_string(obj)
+        self._current[name] = value
+
+    def value_converter(self, field):
+        # as _value_from_field()
+        if (is_passthrough(field)):
+            return None
+        to_string = value_to_string_converter(field)
+        def convert(value):
+            return value if is_protected_type(value) else to_string(value)
+        return convert
+
+    def handle_row(self, model_path, pk, fields, values):
+        data = OrderedDict([('model', model_path)])
+        data['pk'] = pk
+        data['fields'] = OrderedDict(zip([field.name for field in fields], values))
+        self.end_record(data)
 
     def getvalue(self):
         return self.objects
@@ -71,8 +99,6 @@ class NonrelationalDeserializer(nonrelational_base.NonrelationalDeserializer):
     If no parser can return the dicts, then this class can not be 
     implemented.
     """
-    field_names_cache = {}  # model_class: <list of field_names>
-
     def __init__(self, stream_or_string, *, using=DEFAULT_DB_ALIAS, ignorenonexistent=False, **options):
         super().__init__(stream_or_string, **options)
         ol = self.get_object_list(self.stream)
@@ -114,15 +140,13 @@ class NonrelationalDeserializer(nonrelational_base.NonrelationalDeserializer):
                 data[model_class._meta.pk.attname] = self.pk_to_python(model_class, pk)
             except Exception as e:
                 raise base.DeserializationError.WithData(e, model_path, pk, None)
-        if model_class not in self.field_names_cache:
-            self.field_names_cache[model_class] = self.field_names(model_class)
-        field_names = self.field_names_cache[model_class]
+        plan = get_plan(model_class)
 
         # Handle each field
         for (field_name, field_value) in self.fields_from_data(d).items():
-            if self.ignore and field_name not in field_names:
+            if self.ignore and field_name not in plan.name_set:
                 continue
-            field = model_class._meta.get_field(field_name)
+            field = plan.get_field(field_name)
 
             # Do not handle relation fields.
             if(self.field_is_nonrelational(self.ignore, model_class, field)):
@@ -137,5 +161,4 @@ class NonrelationalDeserializer(nonrelational_base.NonrelationalDeserializer):
                         field_value
                     ))
 
-        obj = base.build_instance(model_class, data, self.db)
-        return base.DeserializedObject(obj)
+        return self.build_object(model_class, data)
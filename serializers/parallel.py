@@ -0,0 +1,139 @@
+import io
+import os
+import mmap
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.core.files.uploadedfile import TemporaryUploadedFile
+
+
+'''
+Parallel parsing of delimited text files.
+
+A file on disk is split into byte ranges which start and end on record
+boundaries, and the ranges are parsed in a process pool. Results come
+back in file order.
+
+Records end at a newline outside quotes. A newline is outside quotes
+if the count of quote characters from the start of its record is even
+(an escaped quote, '""', adds two). This needs an ASCII-compatible
+encoding, and a dialect which escapes quotes by doubling (as 'excel').
+'''
+
+
+
+def spooled_path(stream):
+    '''
+    Return the path of a stream which is a file on disk, else None.
+
+    Django uploads larger than FILE_UPLOAD_MAX_MEMORY_SIZE are spooled
+    to a temporary file. Smaller uploads are held in memory, and have
+    no path.
+    '''
+    temporary_file_path = getattr(stream, 'temporary_file_path', None)
+    if callable(temporary_file_path):
+        return temporary_file_path()
+    if isinstance(stream, io.IOBase):
+        name = getattr(stream, 'name', None)
+        if (isinstance(name, str) and os.path.isfile(name)):
+            return name
+    return None
+
+
+def spool_upload(uploadfile):
+    '''
+    Copy an upload held in memory to a temporary file on disk, as
+    Django spools large uploads, so it has a path.
+
+    @return a TemporaryUploadedFile, deleted when closed
+    '''
+    spooled = TemporaryUploadedFile(uploadfile.name, uploadfile.content_type, uploadfile.size, uploadfile.charset)
+    for chunk in uploadfile.chunks():
+        spooled.write(chunk)
+    spooled.flush()
+    spooled.seek(0)
+    return spooled
+
+
+def record_end(m, start, pos, quotechar=b'"'):
+    '''
+    Find the end of a record.
+
+    @param m bytes-like data (e.g. a memory map)
+    @param start offset of a record start
+    @param pos offset to search from, not less than start
+    @return offset after the first newline at or after pos which ends
+    a record, or len(m)
+    '''
+    size = len(m)
+    quotes = m[start:pos].count(quotechar)
+    nl = m.find(b'\n', pos)
+    while (nl != -1):
+        quotes += m[pos:nl].count(quotechar)
+        if (not quotes & 1):
+            return nl + 1
+        pos = nl
+        nl = m.find(b'\n', nl + 1)
+    return size
+
+
+def record_ranges(path, start=0, range_size=4 * 1024 * 1024, quotechar=b'"'):
+    '''
+    Split a file, from a record start, into byte ranges of about
+    range_size, aligned to records.
+
+    @return list of (start, end)
+    '''
+    ranges = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if (start >= size):
+            return ranges
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            while (start < size):
+                target = start + range_size
+                end = size if (target >= size) else record_end(m, start, target, quotechar)
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def init_worker():
+    '''
+    Pool initializer. Forked workers inherit the Django setup, spawned
+    workers set it up (from DJANGO_SETTINGS_MODULE).
+    '''
+    if (not apps.ready):
+        django.setup()
+
+
+def iter_parallel(function, path, ranges, workers, *args):
+    '''
+    Run function(path, start, end, *args) over ranges in a process
+    pool, and iterate the results in range order.
+
+    No more than two ranges per worker are in progress, so results
+    waiting to be consumed are bounded. The function, and args, must
+    be picklable (e.g. module level).
+
+    @return generator of the items of the results (results are
+    iterables)
+    '''
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    try:
+        ranges = iter(ranges)
+        pending = collections.deque()
+        for start, end in ranges:
+            pending.append(pool.submit(function, path, start, end, *args))
+            if (len(pending) >= workers * 2):
+                break
+        while (pending):
+            result = pending.popleft().result()
+            for start, end in ranges:
+                pending.append(pool.submit(function, path, start, end, *args))
+                break
+            yield from result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
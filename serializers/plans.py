@@ -0,0 +1,195 @@
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+
+'''
+Serialization plans.
+
+A plan gathers, once per model and field selection, the field data
+the nonrelational serializers and deserializers would otherwise look
+up for every field of every object: the ordered field list, internal
+types, which fields give values that can be written as they come, and
+the value converters of each serializer.
+
+Plans are cached for the life of the process. Converters built by a
+serializer (see SerializationPlan.converters()) are cached on the
+plan, so they must not depend on per-run options.
+'''
+
+
+
+class ValueHolder():
+    '''
+    Stand-in for a model instance, carrying one attribute.
+    '''
+    pass
+
+
+
+def value_to_string_converter(field):
+    '''
+    Return a callable which gives field.value_to_string() for a raw 
+    value, with no model instance. 
+    '''
+    field_class = type(field)
+    if (field_class.value_to_string is models.Field.value_to_string
+        and field_class.value_from_object is models.Field.value_from_object):
+        return str
+    attname = field.attname
+    def convert(value):
+        holder = ValueHolder()
+        holder.__dict__[attname] = value
+        return field.value_to_string(holder)
+    return convert
+
+
+
+BOOLEAN_STRINGS = {'t': True, 'True': True, '1': True, 'f': False, 'False': False, '0': False}
+
+def to_python_converter(field):
+    '''
+    Return a callable which gives field.to_python() for a text (or 
+    None) value, or None if to_python() returns such values as they
+    are. 
+
+    Fields which use Django's own to_python() for integers, floats and
+    booleans convert directly. Values the direct conversion refuses go
+    to to_python(), so errors are the field's own.
+    '''
+    to_python = field.to_python
+    method = type(field).to_python
+    if (method is models.CharField.to_python or method is models.TextField.to_python):
+        return None
+    if (method is models.IntegerField.to_python or method is models.FloatField.to_python):
+        number = int if (method is models.IntegerField.to_python) else float
+        def convert(value):
+            try:
+                return number(value)
+            except (TypeError, ValueError):
+                return to_python(value)
+        return convert
+    if (method is models.BooleanField.to_python):
+        def convert(value):
+            b = BOOLEAN_STRINGS.get(value)
+            return to_python(value) if (b is None) else b
+        return convert
+    return to_python
+
+
+
+# Django field classes whose values are always protected types
+# (None, numbers, dates, Decimals) or plain strings. Values of these
+# can be written as they come. Subclasses may not behave, so the test
+# is on the exact class name, within Django.
+PASSTHROUGH_TYPES = {
+    'AutoField', 'BigAutoField', 'SmallAutoField',
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'PositiveBigIntegerField',
+    'FloatField', 'DecimalField', 'BooleanField', 'NullBooleanField',
+    'DateField', 'DateTimeField', 'TimeField',
+    'CharField', 'TextField', 'SlugField', 'EmailField', 'URLField',
+}
+
+
+
+def is_passthrough(field):
+    field_class = type(field)
+    return (field_class.__module__.startswith('django.db.models.fields')
+        and field_class.__name__ in PASSTHROUGH_TYPES)
+
+
+
+class SerializationPlan():
+    '''
+    Field data for a model and a field selection.
+
+    @param model_class the model
+    @param fields field selection (attnames), or None for all
+    @param use_natural_primary_keys as the serializer option
+    '''
+    def __init__(self, model_class, fields=None, use_natural_primary_keys=False):
+        self.model_class = model_class
+        self.model_path = str(model_class._meta)
+        self.pk = model_class._meta.pk
+        concrete_model = model_class._meta.concrete_model
+
+        # When using natural primary keys, the pk of the parent for
+        # multi-table inheritance child models must be serialized
+        pk_parent = None
+        if (use_natural_primary_keys):
+            pk = concrete_model._meta.pk
+            if (pk.remote_field and pk.remote_field.parent_link):
+                pk_parent = pk
+
+        # all serializable local fields, in model order
+        self.local_fields = tuple(f for f in concrete_model._meta.local_fields if f.serialize)
+        # the selection, as Django's serializer loop
+        selected = []
+        for field in concrete_model._meta.local_fields:
+            if field.serialize or field is pk_parent:
+                if field.remote_field is None:
+                    if (fields is None or field.attname in fields):
+                        selected.append(field)
+                elif (fields is None or field.attname[:-3] in fields):
+                    selected.append(field)
+        self.fields = tuple(selected)
+        self.many_to_many = tuple(f for f in concrete_model._meta.many_to_many
+            if f.serialize and (fields is None or f.attname in fields))
+
+        self.names = tuple(f.name for f in self.local_fields)
+        self.name_set = frozenset(self.names)
+        self.by_name = {f.name: f for f in self.local_fields}
+        self.internal_types = {f.name: f.get_internal_type() for f in self.fields}
+        self.passthrough = {f.name: is_passthrough(f) for f in self.fields}
+        self.nonrelational = all(f.remote_field is None for f in self.fields) and not self.many_to_many
+
+        # Fields to read with values_list(), or None if the model can
+        # not be handled that way. Relational fields (which error),
+        # natural keys, and fields with their own descriptors
+        # (e.g. files) are left to the model instance path.
+        self.values_fields = None
+        if (self.nonrelational and not use_natural_primary_keys and all(
+            getattr(f, 'descriptor_class', DeferredAttribute) is DeferredAttribute for f in self.fields
+            )):
+            self.values_fields = self.fields
+        self._converters = {}
+
+    def get_field(self, name):
+        '''
+        As model _meta.get_field(), but local fields are found from 
+        the plan.
+        '''
+        field = self.by_name.get(name)
+        return field if (field is not None) else self.model_class._meta.get_field(name)
+        
+    def converters(self, serializer):
+        '''
+        Return the pk converter and field converters of a serializer
+        for this plan, built once.
+
+        @return (pk_converter, tuple of converters matching 'fields')
+        '''
+        key = type(serializer)
+        converters = self._converters.get(key)
+        if (converters is None):
+            converters = (
+                serializer.pk_converter(self.pk),
+                tuple(serializer.value_converter(f) for f in self.fields)
+            )
+            self._converters[key] = converters
+        return converters
+
+
+
+_plans = {}
+
+def get_plan(model_class, fields=None, use_natural_primary_keys=False):
+    '''
+    Return the (cached) plan for a model and field selection.
+    '''
+    key = (model_class, None if (fields is None) else frozenset(fields), bool(use_natural_primary_keys))
+    plan = _plans.get(key)
+    if (plan is None):
+        plan = SerializationPlan(model_class, fields, use_natural_primary_keys)
+        _plans[key] = plan
+    return plan
@@ -1,27 +1,49 @@
 import io
-from xml.dom import pulldom
+import re
+import collections
+from xml.sax.saxutils import quoteattr
+from xml.parsers import expat
 
 from django.conf import settings
 from django.core.serializers import base
 
-from xml.dom import pulldom
 from django.db import DEFAULT_DB_ALIAS
 
 from .nonrelational_base import NonrelationalSerializer, NonrelationalDeserializer
-from django.utils.xmlutils import (
-    SimplerXMLGenerator, UnserializableContentError,
-)
+from .plans import get_plan, value_to_string_converter
+from django.utils.xmlutils import SimplerXMLGenerator
 
-from django.core.serializers.xml_serializer import getInnerText, DefusedExpatParser
+from django.core.serializers.xml_serializer import (
+    DTDForbidden, EntitiesForbidden, ExternalReferenceForbidden,
+)
 
 
         
-class Serializer(NonrelationalSerializer):        
+# characters needing attention in text content: escapes, and the
+# control characters XML 1.0 can not hold
+SPECIAL_RE = re.compile(r'[&<>\x00-\x08\x0B-\x0C\x0E-\x1F]')
+CONTROL_RE = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]')
+
+
+
+class Serializer(NonrelationalSerializer):
+    """
+    Serialize to XML.
+
+    The document element is written by SimplerXMLGenerator. Objects
+    are written directly, one stream write per object, from opening 
+    tags built once per model and field (with indent), so output is as
+    the generator would give.
+    """
     def indent(self, level):
         if self.options.get('indent') is not None:
             self.xml.ignorableWhitespace('\n' + ' ' * self.options.get('indent') * level)
 
     def start_serialization(self):
+        indent = self.options.get('indent')
+        self._ws = ['' if (indent is None) else '\n' + ' ' * indent * level for level in range(3)]
+        self._object_tags = {}
+        self._field_tags = {}
         self.xml = SimplerXMLGenerator(self.stream, self.options.get("encoding", settings.DEFAULT_CHARSET))
         self.xml.startDocument()
         self.xml.startElement("django-objects", {"version": "1.0"})
@@ -30,94 +52,236 @@ class Serializer(NonrelationalSerializer):
         self.indent(0)
         self.xml.endElement("django-objects")
         self.xml.endDocument()
-                
+
+    def field_tags(self, plan):
+        """
+        Return the opening tags of the fields of a plan, by name.
+        """
+        tags = self._field_tags.get(plan)
+        if (tags is None):
+            ws = self._ws[2]
+            # attributes sorted, as SimplerXMLGenerator
+            tags = {f.name: '{}<field name={} type={}>'.format(
+                ws, 
+                quoteattr(f.name), 
+                quoteattr(plan.internal_types[f.name])
+                ) for f in plan.fields}
+            self._field_tags[plan] = tags
+        return tags
+
+    def escape_value(self, field, value):
+        """
+        Escape text content, in one scan for the common case of 
+        nothing to escape.
+        """
+        if (SPECIAL_RE.search(value) is None):
+            return value
+        if (CONTROL_RE.search(value) is not None):
+            raise ValueError("%s.%s (pk:%s) contains unserializable characters" % (
+                field.model.__name__, field.name, self._current_pk))
+        return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        
     def start_object(self, obj):
         self.verify_object_is_model(obj)
-        
-        self.indent(1)
-        attrs = {'model': self.model_path(obj)}
         obj_pk = obj.pk
-        if obj_pk is not None:
-            attrs['pk'] = str(obj_pk)
-        self.xml.startElement("object", attrs)
+        self.start_record(self.model_path(obj), None if (obj_pk is None) else str(obj_pk))
+
+    def start_record(self, model_path, pk):
+        tag = self._object_tags.get(model_path)
+        if (tag is None):
+            tag = '{}<object model={}'.format(self._ws[1], quoteattr(model_path))
+            self._object_tags[model_path] = tag
+        if pk is not None:
+            self._parts = [tag, ' pk=', quoteattr(pk), '>']
+        else:
+            self._parts = [tag, '>']
+        self._current_pk = pk
           
     def end_object(self, obj):
-        self.indent(1)
-        self.xml.endElement("object")
+        self._parts.append(self._ws[1] + '</object>')
+        self.stream.write(''.join(self._parts))
                          
     def handle_field(self, obj, field):
-        self.indent(2)
-        self.xml.startElement('field', {
-            'name': field.name,
-            'type': self.field_type(field),
-        })
-        
-        if getattr(obj, field.name) is not None:
-            try:
-                self.xml.characters(field.value_to_string(obj))
-            except UnserializableContentError:
-                raise ValueError("%s.%s (pk:%s) contains unserializable characters" % (
-                    obj.__class__.__name__, field.name, obj.pk))
+        if getattr(obj, field.attname) is not None:
+            self.write_field(field, field.value_to_string(obj))
+        else:
+            self.write_field(field, None)
+
+    def write_field(self, field, value):
+        self._parts.append(self.field_tags(self.plan)[field.name])
+        if value is not None:
+            self._parts.append(self.escape_value(field, value))
+            self._parts.append('</field>')
         else:
-            self.xml.addQuickElement("None")
-        self.xml.endElement("field")
+            self._parts.append('<None></None></field>')
+
+    def value_converter(self, field):
+        to_string = value_to_string_converter(field)
+        def convert(value):
+            return None if (value is None) else to_string(value)
+        return convert
+
+    def pk_converter(self, field):
+        def convert(value):
+            return None if (value is None) else str(value)
+        return convert
+
+    def handle_row(self, model_path, pk, fields, values):
+        self.start_record(model_path, pk)
+        tags = self.field_tags(self.plan)
+        parts = self._parts
+        escape_value = self.escape_value
+        for field, value in zip(fields, values):
+            parts.append(tags[field.name])
+            if value is not None:
+                parts.append(escape_value(field, value))
+                parts.append('</field>')
+            else:
+                parts.append('<None></None></field>')
+        self.end_object(None)
 
 
 
 class Deserializer(NonrelationalDeserializer):
+    """
+    Deserialize XML.
+
+    The upload is fed, in blocks, to an expat parser whose handlers
+    gather each <object> directly as (model path, pk, field values). No
+    DOM is built, and records are dropped once deserialized, so memory 
+    stays flat across the file. The parser is hardened as Django's 
+    DefusedExpatParser (no DTDs, entity declarations or external 
+    references).
+    """
+    read_size = 64 * 1024
+
     def __init__(self, stream_or_string, *, using=DEFAULT_DB_ALIAS, ignorenonexistent=False, **options):
         super().__init__(stream_or_string, **options)
-        self.event_stream = pulldom.parse(self.stream, self._make_parser())
+        self.parser = self._make_parser()
+        self.records = collections.deque()
+        self.eof = False
+        # parse state
+        self._object = None
+        self._field_name = None
+        self._field_depth = 0
+        self._text = []
+        self._is_none = False
+        self._depth = 0
         self.db = using
         self.ignore = ignorenonexistent
 
     def _make_parser(self):
         """Create a hardened XML parser (no custom/external entities)."""
-        return DefusedExpatParser()
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.characters
+        parser.StartDoctypeDeclHandler = self.start_doctype_decl
+        parser.EntityDeclHandler = self.entity_decl
+        parser.UnparsedEntityDeclHandler = self.unparsed_entity_decl
+        parser.ExternalEntityRefHandler = self.external_entity_ref_handler
+        return parser
 
-    def __next__(self):
-        for event, node in self.event_stream:
-            if event == "START_ELEMENT" and node.nodeName == "object":
-                self.event_stream.expandNode(node)
-                return self._handle_object(node)
-        raise StopIteration
+    ## hardening
+    def start_doctype_decl(self, name, sysid, pubid, has_internal_subset):
+        raise DTDForbidden(name, sysid, pubid)
+
+    def entity_decl(self, name, is_parameter_entity, value, base, sysid, pubid, notation_name):
+        raise EntitiesForbidden(name, value, base, sysid, pubid, notation_name)
+
+    def unparsed_entity_decl(self, name, base, sysid, pubid, notation_name):
+        raise EntitiesForbidden(name, None, base, sysid, pubid, notation_name)
 
+    def external_entity_ref_handler(self, context, base, sysid, pubid):
+        raise ExternalReferenceForbidden(context, base, sysid, pubid)
 
-    def _handle_object(self, node):
-        """Convert an <object> node to a DeserializedObject."""
+    ## handlers
+    def start_element(self, name, attrs):
+        if (self._object is None):
+            if (name == 'object'):
+                self._object = (attrs.get('model'), attrs.get('pk'), {})
+                self._depth = 0
+            return
+        self._depth += 1
+        if (self._field_name is None):
+            if (name == 'field'):
+                # If the field is missing the name attribute, bail
+                field_name = attrs.get('name')
+                if not field_name:
+                    raise base.DeserializationError("<field> node is missing the 'name' attribute")
+                self._field_name = field_name
+                self._field_depth = self._depth
+                self._text = []
+                self._is_none = False
+        elif (name == 'None'):
+            self._is_none = True
+
+    def end_element(self, name):
+        if (self._object is None):
+            return
+        if (self._depth == 0):
+            self.records.append(self._object)
+            self._object = None
+            return
+        if (self._field_name is not None and self._depth == self._field_depth):
+            self._object[2][self._field_name] = None if (self._is_none) else ''.join(self._text).strip()
+            self._field_name = None
+        self._depth -= 1
+
+    def characters(self, data):
+        # text of a field, including that of any child elements
+        if (self._field_name is not None):
+            self._text.append(data)
+
+    ## iteration
+    def feed(self):
+        """
+        Parse a block of the input.
+        @return False if the input is exhausted.
+        """
+        if (self.eof):
+            return False
+        data = self.stream.read(self.read_size)
+        if (not data):
+            self.eof = True
+        try:
+            self.parser.Parse(data, self.eof)
+        except expat.ExpatError as e:
+            raise base.DeserializationError("XML parse error: {}".format(e))
+        return True
+
+    def __next__(self):
+        while (not self.records):
+            if (not self.feed()):
+                raise StopIteration
+        return self._handle_object(*self.records.popleft())
+
+    def _handle_object(self, model_path, pk, fields):
+        """Convert gathered <object> data to a DeserializedObject."""
         # Look up the model using the model loading mechanism. If this fails,
         # bail.
-        model_path = node.getAttribute("model")
         model_class = self.get_model_class(model_path)
 
         # Start building a data dictionary from the object.
         data = {}
-        if node.hasAttribute('pk'):
-            data[model_class._meta.pk.attname] = self.pk_to_python(model_class,
-                node.getAttribute('pk'))
+        if (pk is not None):
+            data[model_class._meta.pk.attname] = self.pk_to_python(model_class, pk)
 
-        field_names = self.field_names(model_class)
+        plan = get_plan(model_class)
         # Deserialize each field.
-        for field_node in node.getElementsByTagName("field"):
-            # If the field is missing the name attribute, bail
-            field_name = field_node.getAttribute("name")
-            if not field_name:
-                raise base.DeserializationError("<field> node is missing the 'name' attribute")
-
+        for field_name, value in fields.items():
             # Get the field from the Model. This will raise a
             # FieldDoesNotExist if, well, the field doesn't exist, which will
             # be propagated correctly unless ignorenonexistent=True is used.
-            if self.ignore and field_name not in field_names:
+            if self.ignore and field_name not in plan.name_set:
                 continue
-            field = model_class._meta.get_field(field_name)
+            field = plan.get_field(field_name)
 
             # Do not handle relation fields.
             if(self.field_is_nonrelational(self.ignore, model_class, field)):
-                if field_node.getElementsByTagName('None'):
-                    value = None
-                else:
-                    value = field.to_python(getInnerText(field_node).strip())
+                if (value is not None):
+                    value = field.to_python(value)
                 data[field.name] = value
                 
-        obj = base.build_instance(model_class, data, self.db)
-        return base.DeserializedObject(obj)
+        return self.build_object(model_class, data)
@@ -0,0 +1,127 @@
+import io
+import os
+import secrets
+
+from django.conf import settings
+from django.core import serializers
+from django.core.exceptions import ImproperlyConfigured
+
+
+'''
+Pre-generated export snapshots.
+
+A snapshot is the export of a whole model, in one format, written to a
+storage directory as,
+
+    <directory>/<app_label>/<model_name>.<format>
+
+Snapshots are written to a temporary file in the same directory, then
+renamed over the old snapshot, so a reader sees the old file or the
+new, never a part-written one (a response already sending the old file
+carries on). The file modification time is the time of generation.
+
+Write snapshots on demand with write_snapshot(), or on a schedule with
+the 'snapshot_records' management command (e.g. from cron). The
+directory is the 'snapshot_dir' argument, or the setting,
+
+    UPDOWNRECORD_SNAPSHOT_DIR = '/var/lib/myproject/snapshots'
+
+Snapshot files are created as open() creates files, so their mode
+follows the umask. Or set a mode, as for FILE_UPLOAD_PERMISSIONS,
+
+    UPDOWNRECORD_SNAPSHOT_PERMISSIONS = 0o640
+
+DownloadRecordView serves fresh snapshots (see 'snapshot' on the view)
+to downloads of the whole model, with default serializer options.
+'''
+SNAPSHOT_DIR_SETTING = 'UPDOWNRECORD_SNAPSHOT_DIR'
+SNAPSHOT_PERMISSIONS_SETTING = 'UPDOWNRECORD_SNAPSHOT_PERMISSIONS'
+
+# Serializer options which leave the output as the default (the
+# values() path writes the same text), so a snapshot can serve a view
+# with them
+SNAPSHOT_OPTIONS = {'model_class', 'use_values'}
+
+
+
+def snapshot_dir(directory=None):
+    directory = directory or getattr(settings, SNAPSHOT_DIR_SETTING, None)
+    if (not directory):
+        raise ImproperlyConfigured('Snapshots need a directory, from an argument or the {} setting'.format(
+            SNAPSHOT_DIR_SETTING
+        ))
+    return directory
+
+
+def snapshot_name(model_class, format):
+    '''
+    @return the path of a snapshot, relative to the snapshot directory
+    '''
+    return '{}/{}.{}'.format(
+        model_class._meta.app_label,
+        model_class._meta.model_name,
+        format
+    )
+
+
+def snapshot_path(model_class, format, directory=None):
+    return os.path.join(snapshot_dir(directory), *snapshot_name(model_class, format).split('/'))
+
+
+def create_temp(parent, name):
+    '''
+    Create a temporary file, for writing a snapshot. Not by mkstemp(),
+    as mkstemp() files are private, whatever the umask.
+
+    @return (file descriptor, path)
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    for _ in range(100):
+        path = os.path.join(parent, '.{}.{}.tmp'.format(name, secrets.token_hex(8)))
+        try:
+            return (os.open(path, flags, 0o666), path)
+        except FileExistsError:
+            continue
+    raise FileExistsError('No unused temporary file name for snapshot {}'.format(name))
+
+
+def write_snapshot(model_class, format, directory=None, queryset=None, serializer_options=None):
+    '''
+    Serialize a model to its snapshot file, atomically.
+
+    Serializers with serialize_iter() (the 'nonrel_*' serializers) are
+    streamed to the file, so memory use does not grow with the table.
+
+    @param queryset to export. Default, all of the model.
+    @param serializer_options dict of serializer options (e.g. 
+    {'model_class': Firework}, for 'nonrel_csv')
+    @return the snapshot path
+    '''
+    path = snapshot_path(model_class, format, directory)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    if (queryset is None):
+        queryset = model_class._default_manager.all()
+    options = serializer_options or {}
+    serializer = serializers.get_serializer(format)()
+    fd, temp_path = create_temp(parent, os.path.basename(path))
+    try:
+        with open(fd, 'wb') as f:
+            if hasattr(serializer, 'serialize_iter'):
+                for chunk in serializer.serialize_iter(queryset, **options):
+                    f.write(chunk)
+            else:
+                stream = io.TextIOWrapper(f, encoding=settings.DEFAULT_CHARSET, newline='')
+                serializer.serialize(queryset, stream=stream, **options)
+                stream.flush()
+                stream.detach()
+            f.flush()
+            os.fsync(f.fileno())
+        permissions = getattr(settings, SNAPSHOT_PERMISSIONS_SETTING, None)
+        if (permissions is not None):
+            os.chmod(temp_path, permissions)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return path
@@ -0,0 +1,91 @@
+import io
+import tempfile
+
+from . import compression
+
+
+'''
+Spooled output for downloads.
+
+SpooledOutput is a text stream for serializers to write to. Output is
+encoded (and, optionally, compressed) onto a SpooledTemporaryFile,
+which is held in memory up to max_size bytes and moved to a temporary
+file on disk past that. So a response can be given a Content-Length
+without the payload being held in memory.
+
+Writes are gathered into blocks before encoding, as serializers often
+write a record, or a value, at a time. Serializers which write bytes
+(the columnar serializer) are passed through.
+'''
+# characters gathered before encoding
+BLOCK_SIZE = 64 * 1024
+
+
+
+class SpooledOutput(io.TextIOBase):
+    '''
+    @param max_size bytes held in memory before spilling to disk
+    @param encoding of written text
+    @param content_encoding compress output, 'gzip' or 'deflate'
+    @param compress_level zlib level
+    '''
+    def __init__(self, max_size, encoding='utf-8', content_encoding=None, compress_level=6):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b')
+        self._encoding = encoding
+        self.compressor = compression.compressor(content_encoding, compress_level) if (content_encoding) else None
+        self.parts = []
+        self.pending = 0
+        # bytes written, before compression
+        self.size = 0
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, str):
+            self.parts.append(data)
+            self.pending += len(data)
+            if (self.pending >= BLOCK_SIZE):
+                self.flush()
+        else:
+            self.flush()
+            self.put(data)
+        return len(data)
+
+    def flush(self):
+        if (self.parts):
+            data = ''.join(self.parts).encode(self._encoding)
+            self.parts = []
+            self.pending = 0
+            self.put(data)
+
+    def put(self, data):
+        self.size += len(data)
+        if (self.compressor is not None):
+            data = self.compressor.compress(data)
+        if (data):
+            self.file.write(data)
+
+    @property
+    def rolled(self):
+        '''
+        True if the output spilled to disk
+        '''
+        return self.file._rolled
+
+    def finish(self):
+        '''
+        End the output.
+        @return (file, length). The file is at the start.
+        '''
+        self.flush()
+        if (self.compressor is not None):
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        length = self.file.tell()
+        self.file.seek(0)
+        return (self.file, length)
@@ -1,13 +1,35 @@
 import io
 import collections
 import os
+import base64
+import datetime
+import hashlib
+import time
+from urllib.parse import quote
 
 
 from django import forms
-from django.core.exceptions import ValidationError, ImproperlyConfigured
-from django.http import HttpResponse, Http404
+from django.core.exceptions import ValidationError, ImproperlyConfigured, EmptyResultSet
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse, Http404
 from django.views.generic import View
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models.query import QuerySet
 from django.core import serializers as serializers
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from . import compression
+from .pipeline import Pipeline
+from .spooling import SpooledOutput
+from .snapshots import snapshot_name, snapshot_path, SNAPSHOT_OPTIONS
+from .instrumentation import TimingMixin
+from .profiling import ProfilingMixin, PROFILE_PARAM
+from .serializers.nonrelational_base import NonrelationalSerializer, NonrelationalDeserializer
+from .serializers.parallel import spooled_path, spool_upload
 
 #! protect
 try:
@@ -15,7 +37,7 @@ try:
 except ImportError:
     raise ImportError('UpdownRecord requires the Quickviews module.')
 
-'''
+r'''
 == Structure of data
 The app can handle both single objects and querysets.
 When handling a queryset, the data will be structured, pseudo-code, as
@@ -94,7 +116,9 @@ SERIALIZATION_DATA = [
     SerializationData("nonrel_csv",  ['text/csv', 'application/csv'], ['csv'], True),
     SerializationData("nonrel_freecfg", ['text/plain'], ['cfg', 'freecfg', 'ini'], False),
     SerializationData("nonrel_json", ['text/json', 'application/json'], ['json'], False),
+    SerializationData("nonrel_jsonl", ['application/x-ndjson', 'application/jsonl'], ['jsonl', 'ndjson'], False),
     SerializationData("nonrel_xml", ['text/xml', 'application/xml'], ['xml'], False),
+    SerializationData("nonrel_columnar", ['application/vnd.updownrecord.columnar'], ['udc'], False),
 ]
 
 def mime_map():
@@ -121,7 +145,7 @@ FORMAT_MAP = {d.format : d for d in SERIALIZATION_DATA}
 
 
 
-class DownloadRecordView(View):
+class DownloadRecordView(ProfilingMixin, TimingMixin, View):
     '''
     
     By default the view downloads a single record selected by 
@@ -149,8 +173,55 @@ class DownloadRecordView(View):
         
     http://127.0.0.1:8000/firework/download?page=2 
         
+    Paging by pk range returns short pages when pks have gaps. If 
+    'use_keyset_paging = True' the model is paged by cursor instead. 
+    Pages are ordered by queryset_cursor_field (default 'pk', which must
+    be unique and should be indexed) and are always queryset_page_size
+    long, except the last. The first page has no cursor. Following pages
+    are found from an opaque token in queryset_url_cursor_kwarg 
+    (default = 'after') e.g. ::
+
+    http://127.0.0.1:8000/firework/download?after=MjU 
+
+    The response carries a 'Link: <...>; rel="next"' header with the URL
+    of the next page (none on the last page). Each page is a single 
+    index-backed query, so deep pages cost the same as the first.
+    
+    If 'conditional_get = True' responses carry ETag (and, if possible,
+    Last-Modified) headers, and If-None-Match/If-Modified-Since 
+    requests are answered with 304 before any serialization. The 
+    validators come from get_version(), if overridden to return a value
+    (e.g. a counter the application keeps), else from the pks of the 
+    selection and the latest value of 'last_modified_field'. With
+    neither there are no validators.
+    
+    If 'export_cache' names a Django cache, serialized bodies are 
+    stored there, keyed on model, selection, format and serializer 
+    options, and served until the validators change. This needs 
+    conditional_get. Bodies larger than export_cache_max_size are not 
+    stored, and streamed responses are never stored (though they can
+    be served from the cache). Bound the cache size through the cache 
+    backend (e.g. MAX_ENTRIES).
+    
+    If 'compress = True' the view honours Accept-Encoding, and sends 
+    gzip or deflate content. Compression runs on the serializer output
+    as it is produced, so works with streaming. If 
+    'compress_attachment = True' the download is a gzip file, whatever
+    Accept-Encoding says, offered with a '.gz' filename (e.g. 
+    'page-1.csv.gz'). The level for both is compress_level.
+    
+    If 'snapshot = True' the view first looks for a snapshot of the 
+    whole model, in the format, written by the 'snapshot_records' 
+    command or snapshots.write_snapshot(). If one is younger than 
+    snapshot_max_age it is sent, with no queries or serialization, as a
+    FileResponse, or by the web server through an X-Accel-Redirect 
+    (nginx; give the internal location as snapshot_url_prefix) or 
+    X-Sendfile (Apache mod_xsendfile...) header. Otherwise the request 
+    is handled as usual. Use on views which export the whole model.
+    
     Offered filenames are: for a single object, the pk of the source record.
-    For a paged queryset 'page-[?]'. For a custom queryset, 'query' 
+    For a paged queryset 'page-[?]'. For a keyset page 'after-[token]' 
+    (the first page is 'after-start'). For a custom queryset, 'query' 
     (overridable on selection_id). Filenames are not intended as unique 
     identifiers. 
     
@@ -158,11 +229,35 @@ class DownloadRecordView(View):
     which makes the filename closer to a unique name, set 
     'model_in_filename=True'.
     
+    If 'streaming=True' the response is a StreamingHttpResponse, fed 
+    chunk by chunk from the serializer. The queryset is not cached, and
+    the payload is never held whole. This needs a serializer with a
+    serialize_iter() method (the 'nonrel_*' serializers). Other 
+    serializers fall back to a buffered response.
+    
     @param format format to serialze to (required).
     @param model_class only classes of this model wil be allowed.
     @param pk_url_kwarg name of argument for pks
     @param use_querysets override the pk_url_kwarg for query handling.
+    @param use_keyset_paging page the model by cursor, not pk range
     @param model_in_filename prefix the filename with the model name
+    @param streaming stream the response from a serializer generator
+    @param conditional_get answer conditional requests from validators
+    @param last_modified_field name of a DateTimeField updated on edits
+    @param export_cache alias of a Django cache for serialized bodies
+    @param compress negotiate gzip/deflate content encoding
+    @param compress_attachment send a gzip file, with a '.gz' filename
+    @param compress_level zlib compression level, 1-9
+    @param stream_chunk_size approximate size of streamed chunks
+    @param spool_max_size spool non-streamed output, in memory up to 
+    this many bytes, on disk after
+    @param snapshot serve a fresh snapshot of the model, if there is one
+    @param snapshot_dir directory of snapshots (default, the setting)
+    @param snapshot_max_age seconds a snapshot is fresh (None, always)
+    @param snapshot_sendfile None, 'x-accel-redirect' or 'x-sendfile'
+    @param snapshot_url_prefix internal URL of the snapshot directory, 
+    for X-Accel-Redirect
+    @param instrument time phases, set a Server-Timing header
     '''
     # XML as default
     format="xml"
@@ -173,10 +268,32 @@ class DownloadRecordView(View):
     queryset = None
     queryset_url_page_kwarg = 'page'
     queryset_page_size = 25
+    use_keyset_paging = False
+    queryset_url_cursor_kwarg = 'after'
+    queryset_cursor_field = 'pk'
+    next_cursor = None
     selection_id = 'query'
     #include_pk = True
     serializer_options = {}
     model_in_filename = False
+    streaming = False
+    stream_chunk_size = 64 * 1024
+    conditional_get = False
+    last_modified_field = None
+    export_cache = None
+    export_cache_timeout = 300
+    export_cache_max_size = 1024 * 1024
+    compress = False
+    compress_attachment = False
+    compress_level = 6
+    spool_max_size = None
+    snapshot = False
+    snapshot_dir = None
+    snapshot_max_age = 3600
+    snapshot_sendfile = None
+    snapshot_url_prefix = None
+    
+    SNAPSHOT_SENDFILE = (None, 'x-accel-redirect', 'x-sendfile')
       
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -184,6 +301,20 @@ class DownloadRecordView(View):
             raise ImproperlyConfigured(
                 "DownloadRecordView requires a definition of 'format'")
 
+        if (self.snapshot):
+            if (not self.model_class):
+                raise ImproperlyConfigured(
+                    "DownloadRecordView configured with 'snapshot'. Snapshots require a model_class attribute to be declared.")
+            if (self.snapshot_sendfile not in self.SNAPSHOT_SENDFILE):
+                raise ImproperlyConfigured(
+                    "DownloadRecordView snapshot_sendfile must be one of {}. snapshot_sendfile:'{}'".format(
+                    ', '.join(str(v) for v in self.SNAPSHOT_SENDFILE),
+                    self.snapshot_sendfile
+                    ))
+            if (self.snapshot_sendfile == 'x-accel-redirect' and not self.snapshot_url_prefix):
+                raise ImproperlyConfigured(
+                    "DownloadRecordView configured with snapshot_sendfile 'x-accel-redirect'. This requires a snapshot_url_prefix (the internal location of the snapshot directory).")
+
         serializer_data = FORMAT_MAP.get(self.format, None)
                 
         if (serializer_data and serializer_data.requires_model):
@@ -192,7 +323,8 @@ class DownloadRecordView(View):
                     "DownloadRecordView configured with format '{}'. This format requires a model_class attribute to be declared.".format(
                     self.format
                     ))             
-            self.serializer_options['model_class'] = self.model_class
+            # copy, not the class attribute
+            self.serializer_options = dict(self.serializer_options, model_class=self.model_class)
 
         if (not self.mime):
             if (not serializer_data):
@@ -235,6 +367,8 @@ class DownloadRecordView(View):
             queryset = self.queryset
             if isinstance(queryset, QuerySet):
                 queryset = queryset.all()
+        elif (self.model_class is not None and self.use_keyset_paging):
+            queryset = self.get_keyset_page()
         elif self.model_class is not None:
             try:
                 # this is how to get query args from Django 
@@ -266,6 +400,73 @@ class DownloadRecordView(View):
             )
         return queryset
 
+    def cursor_field(self):
+        if (self.queryset_cursor_field == 'pk'):
+            return self.model_class._meta.pk
+        return self.model_class._meta.get_field(self.queryset_cursor_field)
+        
+    def encode_cursor(self, value):
+        return base64.urlsafe_b64encode(str(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, token):
+        try:
+            padding = '=' * (-len(token) % 4)
+            value = base64.urlsafe_b64decode(token + padding).decode('utf-8')
+            return self.cursor_field().to_python(value)
+        except Exception:
+            raise Http404("Invalid page cursor requested '{}'".format(
+                token
+            ))
+          
+    def get_keyset_page(self):
+        """
+        Return a page of objects following the cursor in the query 
+        string.
+        
+        The page is one query, filtered and ordered on the cursor field.
+        One object more than the page size is requested. If it arrives, 
+        there is a next page, and 'next_cursor' is set. 
+        
+        @return a list of objects
+        """
+        field_name = self.queryset_cursor_field
+        token = self.request.GET.get(self.queryset_url_cursor_kwarg, None)
+        queryset = self.model_class._default_manager.order_by(field_name)
+        selection = 'start'
+        if (token):
+            after = self.decode_cursor(token)
+            queryset = queryset.filter(**{field_name + '__gt': after})
+            # the token re-encoded from the validated value, so the 
+            # filename holds no client text
+            selection = self.encode_cursor(after)
+        objects = list(queryset[:self.queryset_page_size + 1])
+        if (not objects):
+            raise Http404("Query is empty, possibly cursor is past the end of the data?: cursor:'{}'".format(
+                token
+            ))
+        if (len(objects) > self.queryset_page_size):
+            objects = objects[:self.queryset_page_size]
+            self.next_cursor = self.encode_cursor(getattr(objects[-1], field_name))
+        self.selection_id = 'after-{}'.format(selection)
+        return objects
+
+    def next_page_url(self):
+        query = self.request.GET.copy()
+        query[self.queryset_url_cursor_kwarg] = self.next_cursor
+        # never pass on a profiling token
+        query.pop(PROFILE_PARAM, None)
+        return self.request.build_absolute_uri('{}?{}'.format(
+            self.request.path,
+            query.urlencode()
+        ))
+        
+    def file_extension(self):
+        serializer_data = FORMAT_MAP.get(self.format, None)
+        extension = serializer_data.file_extensions[0] if (serializer_data) else self.format
+        if (self.compress_attachment):
+            extension = '{}.{}'.format(extension, compression.ATTACHMENT_EXTENSION)
+        return extension
+        
     def destination_filename(self, selection_id, extension, to=None):
         modelstr = ''
         if (self.model_in_filename):
@@ -277,22 +478,263 @@ class DownloadRecordView(View):
         )
         return filename
             
+    def get_version(self, queryset):
+        """
+        Return a version for a selection, or None.
+        
+        Override to supply a cheap version (a counter, a hash from an 
+        audit table...). The value is used for the ETag, and must change
+        whenever the serialized data would.
+        """
+        return None
+
+    def options_key(self):
+        return repr(sorted((k, repr(v)) for k, v in self.serializer_options.items()))
+        
+    def make_etag(self, version):
+        key = '{}:{}:{}'.format(self.format, self.options_key(), version)
+        return quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+        
+    def get_validators(self, queryset):
+        """
+        Return validators for a selection.
+        
+        From get_version(), if that returns a value. Otherwise from the 
+        pks of the selection and the latest value of 
+        'last_modified_field', read in one two-column query (or from 
+        the objects, if the queryset is a list).
+        
+        @return (etag, last_modified). Either may be None. etag is 
+        quoted, last_modified is a timestamp.
+        """
+        version = self.get_version(queryset)
+        if (version is not None):
+            return (self.make_etag(version), None)
+        if (not self.last_modified_field):
+            return (None, None)
+        if isinstance(queryset, QuerySet):
+            rows = queryset.values_list('pk', self.last_modified_field)
+        else:
+            rows = [(obj.pk, getattr(obj, self.last_modified_field)) for obj in queryset]
+        pk_hash = hashlib.md5()
+        latest = None
+        for pk, modified in rows:
+            pk_hash.update('{},'.format(pk).encode('utf-8'))
+            if ((modified is not None) and (latest is None or modified > latest)):
+                latest = modified
+        last_modified = None
+        if (latest is not None):
+            if (not timezone.is_aware(latest)):
+                latest = timezone.make_aware(latest, datetime.timezone.utc)
+            last_modified = int(latest.timestamp())
+            latest = latest.isoformat()
+        version = '{}:{}'.format(pk_hash.hexdigest(), latest)
+        return (self.make_etag(version), last_modified)
+
+    def get_content_encoding(self, request):
+        """
+        @return the compression to use, or None
+        """
+        if (self.compress_attachment):
+            return 'gzip'
+        if (self.compress):
+            return compression.negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        return None
+        
+    def export_cache_key(self, queryset, content_encoding=None):
+        model_class = self.model_class or getattr(queryset, 'model', None)
+        key = '{}:{}:{}:{}:{}'.format(
+            model_class._meta.label if (model_class) else '',
+            self.selection_id,
+            self.format,
+            self.options_key(),
+            content_encoding
+        )
+        return 'updownrecord.export.{}'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def snapshot_applies(self):
+        """
+        Return True if the download is what a snapshot holds, the whole
+        model, from the default manager, with default serializer 
+        options. 
+
+        So the view has a 'queryset' of the default manager's all(), 
+        and no get_queryset() override, paging, or options beyond 
+        SNAPSHOT_OPTIONS. Snapshots are sent as they are stored (not
+        compressed), so are not used for compress_attachment.
+        """
+        if (not self.use_querysets or self.use_keyset_paging or self.compress_attachment):
+            return False
+        # an override may select anything
+        if (type(self).get_queryset is not DownloadRecordView.get_queryset):
+            return False
+        if (not isinstance(self.queryset, QuerySet) or self.queryset.model is not self.model_class):
+            return False
+        if (any(k not in SNAPSHOT_OPTIONS for k in self.serializer_options)):
+            return False
+        try:
+            return (self.queryset.query.sql_with_params() == self.model_class._default_manager.all().query.sql_with_params())
+        except EmptyResultSet:
+            return False
+
+    def snapshot_response(self, request):
+        """
+        Return a response serving a fresh snapshot, or None if there 
+        is none, or the download is not of the whole model.
+        """
+        if (not self.snapshot_applies()):
+            return None
+        path = snapshot_path(self.model_class, self.format, self.snapshot_dir)
+        f = None
+        try:
+            if (self.snapshot_sendfile is None):
+                # stat the opened file, in case of a replacement
+                f = open(path, 'rb')
+                st = os.fstat(f.fileno())
+            else:
+                st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if (self.snapshot_max_age is not None and time.time() - st.st_mtime > self.snapshot_max_age):
+            if (f):
+                f.close()
+            return None
+        etag = None
+        last_modified = None
+        if (self.conditional_get):
+            etag = quote_etag('{:x}-{:x}'.format(st.st_mtime_ns, st.st_size))
+            last_modified = int(st.st_mtime)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if (response is not None):
+                if (f):
+                    f.close()
+                return self.set_validator_headers(response, etag, last_modified)
+        if (f):
+            response = FileResponse(f, content_type=self.mime)
+        else:
+            # the web server sends the file
+            response = HttpResponse(content_type=self.mime)
+            if (self.snapshot_sendfile == 'x-accel-redirect'):
+                response['X-Accel-Redirect'] = '{}/{}'.format(
+                    self.snapshot_url_prefix.rstrip('/'),
+                    quote(snapshot_name(self.model_class, self.format))
+                )
+            else:
+                response['X-Sendfile'] = path
+        dstfilename = self.destination_filename(self.selection_id, self.file_extension())
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(dstfilename)
+        return self.set_validator_headers(response, etag, last_modified)
+
     def get(self, request, *args, **kwargs):
+        if (self.snapshot):
+            response = self.snapshot_response(request)
+            if (response is not None):
+                return response
         if (not self.use_querysets):
             pk = int(kwargs[self.pk_url_kwarg])
             qs = self.model_class._default_manager.filter(pk=pk)
             self.selection_id = str(pk)
         else:
             qs = self.get_queryset()
-        s = serializers.get_serializer(self.format)
-        serializer = s()
-          
-        serializer.serialize(qs, **self.serializer_options)          
-        # set content and type
-        response = HttpResponse(serializer.getvalue(), content_type=self.mime)
-        dstfilename = self.destination_filename(self.selection_id, self.format)
+
+        content_encoding = self.get_content_encoding(request)
+        etag = None
+        last_modified = None
+        if (self.conditional_get):
+            with self.phase('validate'):
+                etag, last_modified = self.get_validators(qs)
+            if (etag and content_encoding):
+                # compressed bytes are a different representation
+                etag = '{}-{}"'.format(etag[:-1], content_encoding)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if (response is not None):
+                return self.set_validator_headers(response, etag, last_modified)
+
+        cache = None
+        body = None
+        if (self.export_cache and etag):
+            cache = caches[self.export_cache]
+            cache_key = self.export_cache_key(qs, content_encoding)
+            entry = cache.get(cache_key)
+            if (entry and entry[0] == etag):
+                body = entry[1]
+
+        content_type = compression.ATTACHMENT_MIME if (self.compress_attachment) else self.mime
+        if (body is not None):
+            response = HttpResponse(body, content_type=content_type)
+        else:
+            s = serializers.get_serializer(self.format)
+            serializer = s()
+            options = self.serializer_options
+            # non-relational serializers time their own phases
+            timed_serializer = (self.timings is not None and isinstance(serializer, NonrelationalSerializer))
+            if (timed_serializer):
+                options = dict(options, timings=self.timings)
+            if (self.streaming and hasattr(serializer, 'serialize_iter')):
+                chunks = serializer.serialize_iter(qs, chunk_size=self.stream_chunk_size, **options)
+                if (content_encoding):
+                    chunks = compression.compress_iter(chunks, content_encoding, self.compress_level)
+                response = StreamingHttpResponse(chunks, content_type=content_type)
+            else:
+                spool = self.spool_max_size is not None
+                if (spool):
+                    # encoded, and compressed, as written
+                    output = SpooledOutput(self.spool_max_size, settings.DEFAULT_CHARSET, content_encoding, self.compress_level)
+                    options = dict(options, stream=output)
+                if (timed_serializer):
+                    serializer.serialize(qs, **options)
+                else:
+                    with self.phase('serialize'):
+                        serializer.serialize(qs, **options)
+                if (spool):
+                    response = self.spooled_response(output, content_type, cache and cache_key, etag)
+                else:
+                    # set content and type
+                    with self.phase('encode'):
+                        response = HttpResponse(serializer.getvalue(), content_type=content_type)
+                    if (self.timings is not None):
+                        self.timings.bytes = len(response.content)
+                    if (content_encoding):
+                        with self.phase('compress'):
+                            response.content = compression.compress(response.content, content_encoding, self.compress_level)
+                    if (cache and len(response.content) <= self.export_cache_max_size):
+                        cache.set(cache_key, (etag, response.content), self.export_cache_timeout)
+        if (content_encoding and not self.compress_attachment):
+            response['Content-Encoding'] = content_encoding
+        if (self.compress):
+            patch_vary_headers(response, ('Accept-Encoding',))
+        dstfilename = self.destination_filename(self.selection_id, self.file_extension())
         # Add the treat-as-file header
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(dstfilename)
+        if (self.next_cursor):
+            response['Link'] = '<{}>; rel="next"'.format(self.next_page_url())
+        return self.set_validator_headers(response, etag, last_modified)
+
+    def spooled_response(self, output, content_type, cache_key, etag):
+        """
+        Make a response from spooled output.
+        
+        Small bodies go to the export cache (if one is in use), and 
+        are sent from memory. Others are sent from the spool file, with
+        a Content-Length.
+        """
+        f, length = output.finish()
+        if (self.timings is not None):
+            self.timings.bytes = output.size
+        if (cache_key and length <= self.export_cache_max_size):
+            body = f.read()
+            f.close()
+            caches[self.export_cache].set(cache_key, (etag, body), self.export_cache_timeout)
+            return HttpResponse(body, content_type=content_type)
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = length
+        return response
+
+    def set_validator_headers(self, response, etag, last_modified):
+        if (etag):
+            response['ETag'] = etag
+        if (last_modified):
+            response['Last-Modified'] = http_date(last_modified)
         return response
     
     
@@ -313,16 +755,45 @@ def get_upload_form(file_size_limit=None):
 
 
 
-class UploadRecordView(CreateView):
+class UploadRecordView(ProfilingMixin, TimingMixin, CreateView):
     '''
     Simple form to upload structured data to a model.
     
     Success may depend of the form of the data and deserialisation
     chosen.
 
+    By default each object is saved in turn (upload_mode = 'save'),
+    which is a query or two per object. With upload_mode = 'bulk',
+    objects are grouped by model and inserted with bulk_create(), 
+    bulk_batch_size objects at a time, in one transaction. Bulk mode
+    only inserts (an uploaded pk which exists is an error, and the
+    transaction rolls back), does not call save() or send save signals,
+    and can not handle multi-table inherited models. Reported pks are 
+    those the database backend returns from bulk_create() (PostgreSQL,
+    newer SQLite and MariaDB), or the uploaded pks.
+    
+    With upload_mode = 'upsert', each batch is checked against the 
+    database in one in_bulk() query. Objects with no pk, or a pk not
+    found, are inserted with bulk_create(). Objects which exist, and 
+    differ, are written with bulk_update(). Objects which exist and are
+    the same are left alone. The success message adds the counts of 
+    each. The same cautions as bulk mode apply; also, bulk_update() 
+    does not run pre_save(), so 'auto_now' fields are not touched.
+    
+    After bulk or upsert inserts with uploaded pks, database sequences
+    are reset (as 'loaddata' does), so later inserts do not collide.
+
     @param model_class limit the format to this (do not guess)
     @param format limit the format to this (do not guess)
     @param file_size_limit in MB (e.g. value = 2 is 2MB)
+    @param upload_mode 'save', 'bulk' or 'upsert'
+    @param bulk_batch_size objects per bulk query
+    @param parse_workers parse CSV uploads in this many processes (an
+    upload held in memory is spooled to disk first)
+    @param pipeline parse in a thread while saving in this one
+    @param pipeline_queue_size batches parsed ahead of the writer, at 
+    most
+    @param instrument time phases, set a Server-Timing header
     '''
     model_class = None
     format = None
@@ -330,11 +801,25 @@ class UploadRecordView(CreateView):
     file_size_limit = 2
     popnone_normalize = True
     deserialize_options = {}
+    upload_mode = 'save'
+    bulk_batch_size = 500
+    parse_workers = None
+    pipeline = False
+    pipeline_queue_size = 4
+    pipeline_stats = None
     #success_url = self.return_url()
     
+    UPLOAD_MODES = ('save', 'bulk', 'upsert')
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         
+        if (self.upload_mode not in self.UPLOAD_MODES):
+            raise ImproperlyConfigured(
+                "UploadRecordView upload_mode must be one of {}. upload_mode:'{}'".format(
+                ', '.join(self.UPLOAD_MODES),
+                self.upload_mode
+                ))
         serializer_data = FORMAT_MAP.get(self.format, None)
                 
         if (serializer_data and serializer_data.requires_model):
@@ -343,7 +828,8 @@ class UploadRecordView(CreateView):
                     "UploadRecordView configured with format '{}'. This format requires a model_class attribute to be declared.".format(
                     self.format
                     ))             
-            self.deserialize_options['model_class'] = self.model_class
+            # copy, not the class attribute
+            self.deserialize_options = dict(self.deserialize_options, model_class=self.model_class)
         
     def get_form(self, form_class=None):
         form_class = get_upload_form(self.file_size_limit)
@@ -373,31 +859,201 @@ class UploadRecordView(CreateView):
                     extension
                 ))
         return data.format
-        
-    def success_action(self, form):
-        uploadfile = self.request.FILES['data']
-        format = self.format if (self.format) else self.guess_format(uploadfile)
-        gather_pks = bool(self.model_class)
-        msg_b = []
 
+    def profile_format(self):
+        if (self.format):
+            return self.format
+        uploadfile = self.request.FILES.get('data')
+        if (uploadfile is None):
+            return None
+        try:
+            return self.guess_format(uploadfile)
+        except Http404:
+            return None
+        
+    def deserialized_objects(self, format, uploadfile, timings=None):
+        """
+        Deserialize the upload.
+        @param timings record 'parse' and 'build' phases, and rows, to 
+        this (in the iterating thread)
+        @return generator of model instances.
+        """
         # Chime for Django: uploadfile objects are enough of an 
         # iterable string or stream to go into a deserializer direct
         # But only our serializers, as some parsers will not handle 
         # bytes... 
         # R.C.
-        for deserialized_object in serializers.deserialize(format, uploadfile, **self.deserialize_options):
-            obj = deserialized_object.object
-            #print('ouput object:' + str(obj))   
-            # test assertively that models match
-            # (they may fail on fields, but to be sure)        
-            if (self.model_class and (obj._meta.model != self.model_class)):
-                raise ValidationError('Configuration rejected a model type created from uploaded data: configured type:{} : recieved type:{}'.format(
-                    model_class._meta.object_name,
-                    obj._meta.model.object_name,
-                ))
+        options = self.deserialize_options
+        spooled = None
+        if (self.parse_workers and format == 'nonrel_csv'):
+            options = dict(options, workers=self.parse_workers)
+            # ranges are split from a file on disk, so an upload held
+            # in memory is spooled
+            if (self.parse_workers > 1 and spooled_path(uploadfile) is None):
+                uploadfile = spooled = spool_upload(uploadfile)
+        if (timings is not None):
+            deserializer = serializers.get_deserializer(format)
+            if (isinstance(deserializer, type) and issubclass(deserializer, NonrelationalDeserializer)):
+                options = dict(options, timings=timings)
+        try:
+            deserialized_objects = serializers.deserialize(format, uploadfile, **options)
+            if (timings is not None):
+                deserialized_objects = timings.timed_iter(deserialized_objects, 'parse')
+            for deserialized_object in deserialized_objects:
+                obj = deserialized_object.object
+                if (timings is not None):
+                    timings.rows += 1
+                #print('ouput object:' + str(obj))   
+                # test assertively that models match
+                # (they may fail on fields, but to be sure)        
+                if (self.model_class and (obj._meta.model != self.model_class)):
+                    raise ValidationError('Configuration rejected a model type created from uploaded data: configured type:{} : recieved type:{}'.format(
+                        self.model_class._meta.object_name,
+                        obj._meta.object_name,
+                    ))
+                yield obj
+        finally:
+            if (spooled is not None):
+                spooled.close()
+
+    def save_objects(self, objects, msg_b):
+        for obj in objects:
             #? Protect for recovery, or allow to explode on exception?
             obj.save(force_insert=self.force_insert)
-            msg_b.append((obj._meta.model._meta.object_name, obj.pk))
+            msg_b.append((obj._meta.object_name, obj.pk))
+
+    def bulk_save_objects(self, objects, msg_b):
+        """
+        Gather objects into per-model batches, and write each batch 
+        when full.
+        
+        msg_b entries hold the object until the batch is written, then
+        the pk.
+        """
+        self.write_objects(objects, msg_b)
+        self.reset_sequences()
+
+    def write_objects(self, objects, msg_b):
+        batches = {}
+        for obj in objects:
+            model_class = obj._meta.model
+            entry = [obj._meta.object_name, obj]
+            msg_b.append(entry)
+            batch = batches.setdefault(model_class, [])
+            batch.append(entry)
+            if (len(batch) >= self.bulk_batch_size):
+                self.write_batch(model_class, batch)
+                batches[model_class] = []
+        for model_class, batch in batches.items():
+            if (batch):
+                self.write_batch(model_class, batch)
+
+    def pipeline_save_objects(self, objects, msg_b):
+        """
+        Save objects through a Pipeline, so parsing the upload overlaps
+        the database writes. Batches are bulk_batch_size objects, 
+        written as upload_mode.
+        """
+        def write(batch):
+            with self.phase('save'):
+                if (self.upload_mode == 'save'):
+                    self.save_objects(batch, msg_b)
+                else:
+                    self.write_objects(batch, msg_b)
+        pipeline = Pipeline(objects, write, 
+            batch_size=self.bulk_batch_size, 
+            queue_size=self.pipeline_queue_size
+        )
+        self.pipeline_stats = pipeline.run()
+        if (self.upload_mode != 'save'):
+            self.reset_sequences()
+        if (self.timings is not None):
+            # parsing ran alongside, in the parser thread
+            self.timings.add('parse', self.pipeline_stats.parse)
+            self.timings.add('wait', self.pipeline_stats.write_wait)
+            self.timings.rows += self.pipeline_stats.objects
+
+    def write_batch(self, model_class, entries):
+        objs = [e[1] for e in entries]
+        if (self.upload_mode == 'upsert'):
+            self.upsert_batch(model_class, objs)
+        else:
+            self.insert_batch(model_class, objs)
+        for e in entries:
+            e[1] = e[1].pk
+            
+    def insert_batch(self, model_class, objs):
+        if (any(obj.pk is not None for obj in objs)):
+            self.sequence_models.add(model_class)
+        model_class._default_manager.bulk_create(objs, batch_size=self.bulk_batch_size)
+        self.upload_counts['inserted'] += len(objs)
+        
+    def upsert_batch(self, model_class, objs):
+        """
+        Insert new objects, update changed objects.
+        
+        Where objects in the batch share a pk, only the last is 
+        written, so the result is as saving each in turn.
+        """
+        # the last object of each pk
+        latest = {obj.pk: obj for obj in objs if obj.pk is not None}
+        existing = model_class._default_manager.in_bulk(list(latest)) if (latest) else {}
+        fields = [f for f in model_class._meta.concrete_fields if not f.primary_key]
+        new_objs = []
+        changed_objs = []
+        for obj in objs:
+            if (obj.pk is not None and latest[obj.pk] is not obj):
+                continue
+            current = existing.get(obj.pk) if (obj.pk is not None) else None
+            if (current is None):
+                new_objs.append(obj)
+            elif any(getattr(obj, f.attname) != getattr(current, f.attname) for f in fields):
+                changed_objs.append(obj)
+            else:
+                self.upload_counts['unchanged'] += 1
+        if (new_objs):
+            self.insert_batch(model_class, new_objs)
+        if (changed_objs):
+            model_class._default_manager.bulk_update(changed_objs, [f.name for f in fields], batch_size=self.bulk_batch_size)
+            self.upload_counts['updated'] += len(changed_objs)
+
+    def reset_sequences(self):
+        """
+        Reset sequences of models which had objects inserted with pks.
+        """
+        for model_class in self.sequence_models:
+            connection = connections[router.db_for_write(model_class)]
+            sequence_sql = connection.ops.sequence_reset_sql(no_style(), [model_class])
+            if (sequence_sql):
+                with connection.cursor() as cursor:
+                    for line in sequence_sql:
+                        cursor.execute(line)
+        self.sequence_models = set()
+        
+    def success_action(self, form):
+        uploadfile = self.request.FILES['data']
+        format = self.format if (self.format) else self.guess_format(uploadfile)
+        gather_pks = bool(self.model_class)
+        msg_b = []
+
+        self.upload_counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        self.sequence_models = set()
+        
+        if (self.timings is not None):
+            self.timings.bytes = uploadfile.size
+        if (self.pipeline):
+            # the parser thread does not record to the timings
+            objects = self.deserialized_objects(format, uploadfile)
+            with transaction.atomic():
+                self.pipeline_save_objects(objects, msg_b)
+        else:
+            objects = self.deserialized_objects(format, uploadfile, self.timings)
+            with self.phase('save'):
+                if (self.upload_mode == 'save'):
+                    self.save_objects(objects, msg_b)
+                else:
+                    with transaction.atomic():
+                        self.bulk_save_objects(objects, msg_b)
             
         if (gather_pks):
             pks = [str(e[1]) for e in msg_b]
@@ -405,4 +1061,9 @@ class UploadRecordView(CreateView):
         else:
             model_details = ['{}:{}'.format(e[0], e[1]) for e in msg_b]
             msg = ', '.join(model_details) 
+        if (self.upload_mode == 'upsert'):
+            msg = '{} (inserted:{inserted}, updated:{updated}, unchanged:{unchanged})'.format(
+                msg,
+                **self.upload_counts
+            )
         return msg